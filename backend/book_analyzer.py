@@ -6,6 +6,8 @@ import os
 from typing import Dict, List, Any
 from openai import AsyncOpenAI  # For OpenAI models
 
+from json_utils import json_loads, extract_fenced_json, close_json_brackets
+
 # Import Google Gemini library for better analysis
 try:
     import google.generativeai as genai
@@ -29,17 +31,37 @@ async def analyze_book(book_content: dict) -> dict:
     else:
         return await analyze_with_openai(book_content)
 
+# Gemini setup is cached after the first successful initialization
+_GEMINI_INIT_STATE = {"ready": None, "model": None}
+
+def initialize_gemini():
+    """Configure Gemini and create the analysis model, once per process"""
+    if _GEMINI_INIT_STATE["ready"] is not None:
+        return _GEMINI_INIT_STATE["ready"]
+    
+    api_key = os.environ.get("GEMINI_API_KEY")
+    if not GEMINI_AVAILABLE or not api_key:
+        # Not cached, so setting the key later still enables Gemini
+        return False
+    
+    genai.configure(api_key=api_key)
+    _GEMINI_INIT_STATE["model"] = genai.GenerativeModel('gemini-2.0-flash-thinking-exp-01-21')
+    _GEMINI_INIT_STATE["ready"] = True
+    return True
+
+def reset_gemini():
+    """Forget the cached Gemini setup, e.g. after the API key changes"""
+    _GEMINI_INIT_STATE["ready"] = None
+    _GEMINI_INIT_STATE["model"] = None
+
 async def analyze_with_gemini(book_content: dict) -> dict:
     """
     Use Google's Gemini for deep contextual analysis of the book
     """
-    api_key = os.environ.get("GEMINI_API_KEY")
-    if not api_key:
+    # Configure Gemini (only done once per process)
+    if not initialize_gemini():
         raise ValueError("GEMINI_API_KEY environment variable not set")
     
-    # Configure Gemini
-    genai.configure(api_key=api_key)
-    
     # Extract text from the book content
     book_text = ""
     for page in book_content["content"]:
@@ -142,8 +164,8 @@ async def analyze_with_gemini(book_content: dict) -> dict:
     Focus on providing DEEP, RICH DETAILS for each element. No generalities or placeholders.
     """
     
-    # Create a Gemini model instance with thinking capabilities
-    model = genai.GenerativeModel('gemini-2.0-flash-thinking-exp-01-21')
+    # Reuse the Gemini model instance with thinking capabilities
+    model = _GEMINI_INIT_STATE["model"]
     
     # Generate content with the model
     response = model.generate_content(prompt)
@@ -154,12 +176,12 @@ async def analyze_with_gemini(book_content: dict) -> dict:
         analysis_text = response.text
         
         # Look for JSON content within the response
-        json_match = re.search(r'```json\s*(.*?)\s*```', analysis_text, re.DOTALL)
-        if json_match:
-            analysis_text = json_match.group(1)
+        fenced_json = extract_fenced_json(analysis_text)
+        if fenced_json is not None:
+            analysis_text = fenced_json
         
         # Try to parse as JSON
-        analysis_data = json.loads(analysis_text)
+        analysis_data = json_loads(analysis_text)
         
         # Validate and clean up the analysis data
         analysis_data = validate_analysis_data(analysis_data, book_content)
@@ -297,7 +319,7 @@ async def analyze_with_openai(book_content: dict) -> dict:
         
         try:
             print(f"Received analysis from OpenAI ({len(analysis_text)} chars)")
-            analysis_data = json.loads(analysis_text)
+            analysis_data = json_loads(analysis_text)
             
             # Validate and clean up the analysis data
             analysis_data = validate_analysis_data(analysis_data, book_content)
@@ -309,9 +331,9 @@ async def analyze_with_openai(book_content: dict) -> dict:
             
             # Try to fix the JSON
             try:
-                fixed_text = attempt_json_repair(analysis_text)
+                fixed_text = close_json_brackets(analysis_text)
                 if fixed_text != analysis_text:
-                    analysis_data = json.loads(fixed_text)
+                    analysis_data = json_loads(fixed_text)
                     print("Successfully fixed and parsed JSON")
                     analysis_data = validate_analysis_data(analysis_data, book_content)
                     return analysis_data
@@ -423,26 +445,6 @@ def validate_analysis_data(analysis_data, book_content):
     
     return analysis_data
 
-# Helper function to attempt to repair broken JSON
-def attempt_json_repair(json_text):
-    """Attempt to fix common JSON errors"""
-    # Try to fix unclosed quotes
-    json_text = re.sub(r'([^\\])"([^"]*)$', r'\1"\2"', json_text)
-    
-    # Try to fix missing closing braces
-    open_braces = json_text.count('{')
-    close_braces = json_text.count('}')
-    if open_braces > close_braces:
-        json_text += '}' * (open_braces - close_braces)
-    
-    # Try to fix missing closing brackets
-    open_brackets = json_text.count('[')
-    close_brackets = json_text.count(']')
-    if open_brackets > close_brackets:
-        json_text += ']' * (open_brackets - close_brackets)
-    
-    return json_text
-
 # Enhanced placeholder analysis for when AI fails
 async def placeholder_analysis(book_content: dict) -> dict:
     """Improved fallback analysis if AI fails"""
@@ -0,0 +1,80 @@
+# File: json_utils.py
+import json
+
+# orjson parses the long LLM responses several times faster than the
+# stdlib; its JSONDecodeError subclasses json.JSONDecodeError
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+def extract_fenced_json(text):
+    """
+    Return the body of the first ``` (or ```json) fenced block in a model
+    response, up to the end of the text if the fence never closes, or None
+    if there is no fence
+    """
+    # Two linear scans; no regex backtracking on long or malformed responses
+    start = text.find("```")
+    if start == -1:
+        return None
+    end = text.find("```", start + 3)
+    
+    body = text[start + 3:end] if end != -1 else text[start + 3:]
+    if body[:4].lower() == "json":
+        body = body[4:]
+    return body.strip()
+
+def _scan_brackets(text, start=0, stop_when_balanced=False):
+    """
+    Walk text from start in one left-to-right pass, tracking strings and
+    open brackets; no regex backtracking on long or truncated responses.
+    Returns (end, closers, in_string): end is the index just past the bracket
+    that balances the first one opened if stop_when_balanced, otherwise None.
+    """
+    closers = []
+    in_string = False
+    escaped = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == "{":
+            closers.append("}")
+        elif ch == "[":
+            closers.append("]")
+        elif ch in "}]" and closers and closers[-1] == ch:
+            closers.pop()
+            if stop_when_balanced and not closers:
+                return i + 1, closers, in_string
+    return None, closers, in_string
+
+def extract_json_span(text):
+    """
+    Strip ``` code fences and prose around a model response, returning the
+    first balanced {...} span (or everything from the first "{" if it never closes)
+    """
+    fenced = extract_fenced_json(text)
+    if fenced is not None:
+        text = fenced
+    
+    start = text.find("{")
+    if start == -1:
+        return text.strip()
+    end, _, _ = _scan_brackets(text, start, stop_when_balanced=True)
+    return text[start:end]
+
+def close_json_brackets(json_text):
+    """Close an unterminated string, then any brackets still open, innermost first"""
+    _, closers, in_string = _scan_brackets(json_text)
+    if in_string:
+        json_text += '"'
+    return json_text + "".join(reversed(closers))
@@ -13,14 +13,26 @@ from fastapi.exceptions import RequestValidationError, ResponseValidationError
 import sys
 import os
 import traceback
+import logging
+from contextlib import asynccontextmanager
 
 # Import our processing modules
 from pdf_processor import process_pdf
 from book_analyzer import analyze_book
+import vn_generator
 from vn_generator import generate_visual_novel
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # Close the clients shared across requests on shutdown
+    await vn_generator.close_http_clients()
+
+# Show the generator's log messages alongside the rest of the app's output
+logging.basicConfig(format="%(message)s")
+
 # Create the FastAPI app - THIS WAS MISSING
-app = FastAPI(title="PlotTwist API", description="API for converting books to visual novels")
+app = FastAPI(title="PlotTwist API", description="API for converting books to visual novels", lifespan=lifespan)
 
 # Enable CORS
 app.add_middleware(
@@ -245,57 +257,9 @@ async def get_script(book_id: str):
     if not script_id or script_id not in scripts:
         raise HTTPException(status_code=404, detail="Script not found")
     
-    # Get the raw script
-    raw_script = scripts[script_id]
-    
-    # Format it according to our model
-    formatted_script = {
-        "id": raw_script["id"],
-        "book_id": book_id,
-        "title": raw_script.get("title", book["title"]),
-        "scenes": []
-    }
-    
-    # Format each scene to match our Scene model
-    for scene in raw_script.get("scenes", []):
-        formatted_scene = {
-            "id": scene["id"],
-            "background": scene["background"],
-            "characters": [],
-            "dialogue": []
-        }
-        
-        # Format characters
-        for char in scene.get("characters", []):
-            formatted_scene["characters"].append({
-                "id": char["id"],
-                "image": char["image"]
-            })
-        
-        # Format dialogue
-        for dialogue in scene.get("dialogue", []):
-            formatted_dialogue = {
-                "speaker": dialogue["speaker"],
-                "text": dialogue["text"]
-            }
-            
-            # Add optional fields if present
-            if "character" in dialogue:
-                formatted_dialogue["character"] = dialogue["character"]
-            
-            if "choices" in dialogue:
-                formatted_dialogue["choices"] = []
-                for choice in dialogue["choices"]:
-                    formatted_dialogue["choices"].append({
-                        "text": choice["text"],
-                        "nextScene": choice["nextScene"]
-                    })
-            
-            formatted_scene["dialogue"].append(formatted_dialogue)
-        
-        formatted_script["scenes"].append(formatted_scene)
-    
-    return formatted_script
+    # Scripts are stored already shaped like VNScript, so hand the dict
+    # straight to FastAPI's response_model serializer
+    return scripts[script_id]
 
 
 @app.exception_handler(RequestValidationError)
@@ -377,8 +341,8 @@ async def get_scene(scene_id: str, book_id: str):
     
     # If scene doesn't exist, generate it
     try:
-        # Initialize OpenAI client
-        client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY", "your-openai-api-key"))
+        # Get the shared OpenAI client
+        client = vn_generator.get_openai_client()
         
         # Generate the new scene
         new_scene = await vn_generator.generate_next_scene(scene_id, client)
@@ -1,19 +1,68 @@
 # File: vn_generator.py
 import asyncio
+import copy
+import functools
+import hashlib
 import json
+import logging
+import math
 import random
 import re
 import os
-from typing import Dict, List, Any
-from openai import AsyncOpenAI  # You'll need to pip install openai
+import sqlite3
+import time
+import types
+import zlib
+from collections import OrderedDict, deque
+from typing import Dict, List, Any, Optional
+from openai import AsyncOpenAI, APIConnectionError, InternalServerError, RateLimitError  # You'll need to pip install openai
+from pydantic import BaseModel, ValidationInfo, field_validator
 
-import os
-import tempfile
-import replicate
-import base64
-import requests
-from io import BytesIO
-from PIL import Image
+from json_utils import json_loads, extract_json_span, close_json_brackets
+
+# Image generation dependencies (replicate, requests, Pillow) are imported
+# inside the image helpers, so workers that never generate images skip them
+
+# json_repair fixes the malformed JSON models commonly return (trailing
+# commas, single quotes, truncated output); without it we fall back to
+# closing unbalanced brackets
+try:
+    from json_repair import repair_json
+except ImportError:
+    repair_json = None
+
+# Per-scene and per-image progress is logged at DEBUG, so the default INFO
+# level skips formatting it altogether; set VN_LOG_LEVEL=DEBUG to see it.
+# Handlers are left to the application.
+logger = logging.getLogger("vn_generator")
+_LOG_LEVEL = os.environ.get("VN_LOG_LEVEL", "INFO").upper()
+if isinstance(logging.getLevelName(_LOG_LEVEL), int):
+    logger.setLevel(_LOG_LEVEL)
+else:
+    logger.setLevel(logging.INFO)
+    logger.warning("Unknown VN_LOG_LEVEL %r, using INFO", _LOG_LEVEL)
+
+# Default SVG backgrounds for fallback, shared with the placeholder script
+_DEFAULT_BACKGROUNDS = types.MappingProxyType({
+    "main": "data:image/svg+xml;utf8,<svg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 800 600'><rect width='800' height='600' fill='%23243b55'/><path d='M0 450 Q 400 400 800 450 L 800 600 L 0 600 Z' fill='%23141e30'/></svg>",
+    "secondary": "data:image/svg+xml;utf8,<svg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 800 600'><rect width='800' height='600' fill='%232c3e50'/><path d='M0 450 Q 400 400 800 450 L 800 600 L 0 600 Z' fill='%23141e30'/></svg>",
+    "dark": "data:image/svg+xml;utf8,<svg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 800 600'><rect width='800' height='600' fill='%231a1a2e'/><path d='M0 450 Q 400 400 800 450 L 800 600 L 0 600 Z' fill='%230f0f1a'/></svg>",
+    "light": "data:image/svg+xml;utf8,<svg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 800 600'><rect width='800' height='600' fill='%23e0e0e0'/><path d='M0 450 Q 400 400 800 450 L 800 600 L 0 600 Z' fill='%23c0c0c0'/></svg>",
+    "forest": "data:image/svg+xml;utf8,<svg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 800 600'><rect width='800' height='600' fill='%23234010'/><path d='M0 450 Q 400 400 800 450 L 800 600 L 0 600 Z' fill='%23132010'/></svg>"
+})
+_SCENE_TYPES = tuple(_DEFAULT_BACKGROUNDS)
+
+# Placeholder character silhouette: head, torso and legs in three colors
+_CHAR_SVG_TEMPLATE = "data:image/svg+xml;utf8,<svg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 100 250'><rect x='35' y='20' width='30' height='30' rx='15' fill='%23{c0}'/><rect x='30' y='50' width='40' height='60' fill='%23{c1}'/><rect x='25' y='110' width='50' height='50' fill='%23{c2}'/><rect x='25' y='110' width='20' height='70' rx='5' fill='%23{c2}'/><rect x='55' y='110' width='20' height='70' rx='5' fill='%23{c2}'/></svg>"
+_CHAR_COLORS = ("f9d5e5", "b06ab3", "6a0572", "d1d1e0", "800000", "333333", "e6ccb2", "7b7554", "c0d6df", "4a6fa5")
+
+def _placeholder_character_svg(color_idx):
+    """Render the placeholder silhouette starting at the given color"""
+    return _CHAR_SVG_TEMPLATE.format(
+        c0=_CHAR_COLORS[color_idx % len(_CHAR_COLORS)],
+        c1=_CHAR_COLORS[(color_idx+1) % len(_CHAR_COLORS)],
+        c2=_CHAR_COLORS[(color_idx+2) % len(_CHAR_COLORS)]
+    )
 
 # Add this to the global variables section
 # Cache for generated images to avoid regenerating them
@@ -23,14 +72,221 @@ IMAGE_CACHE = {
 }
 
 
+class LRUCache(OrderedDict):
+    """Dict that evicts its least recently used entries beyond maxsize"""
+    def __init__(self, maxsize):
+        super().__init__()
+        self.maxsize = maxsize
+    
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+    
+    def get(self, key, default=None):
+        # OrderedDict.get bypasses __getitem__, so hits wouldn't refresh recency
+        try:
+            return self[key]
+        except KeyError:
+            return default
+    
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        while len(self) > self.maxsize:
+            self.popitem(last=False)
+
+# Upper bound on cached scenes, so long-running servers don't grow without limit
+SCENE_CACHE_SIZE = int(os.environ.get("SCENE_CACHE_SIZE", "1024"))
+
 # Global cache for story continuation
 STORY_CACHE = {
     "book_analysis": None,      # Store book analysis for reference
-    "generated_scenes": {},     # Cache of all generated scenes
+    "generated_scenes": LRUCache(SCENE_CACHE_SIZE), # Cache of all generated scenes
+    "scene_by_hash": LRUCache(SCENE_CACHE_SIZE),    # Outline content hash -> generated scene
     "scene_graph": {},          # Map showing connections between scenes
-    "in_progress_scenes": set() # Set of scenes currently being generated
+    "in_progress_scenes": {},   # Scene id -> Event set when its generation finishes
+    "book_context": None,       # Rendered prompt context for the current book
+    "char_index": None          # Lowercased character id/name index for the current book
 }
 
+# Persistent cache of raw LLM responses keyed by a hash of the request,
+# so re-adapting the same book doesn't pay for the same completions again.
+# Set LLM_CACHE_PATH to an empty string to disable it.
+LLM_CACHE_PATH = os.environ.get("LLM_CACHE_PATH", os.path.join(".cache", "llm_responses.sqlite"))
+_LLM_CACHE_DB = None
+
+def _llm_cache_db():
+    """Open (once) the sqlite database backing the LLM response cache"""
+    global _LLM_CACHE_DB
+    if _LLM_CACHE_DB is None:
+        cache_dir = os.path.dirname(LLM_CACHE_PATH)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        _LLM_CACHE_DB = sqlite3.connect(LLM_CACHE_PATH)
+        _LLM_CACHE_DB.execute("CREATE TABLE IF NOT EXISTS KV (key BLOB PRIMARY KEY, text BLOB, ts INTEGER)")
+    return _LLM_CACHE_DB
+
+def _llm_cache_key(model, generation_config, messages):
+    """Hash everything that influences the completion into a cache key"""
+    payload = json.dumps([model, generation_config, messages], sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).digest()
+
+def _llm_cache_get(key):
+    if not LLM_CACHE_PATH:
+        return None
+    try:
+        row = _llm_cache_db().execute("SELECT text FROM KV WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+    except sqlite3.Error as e:
+        logger.warning("LLM cache read failed: %s", e)
+        return None
+
+def _llm_cache_put(key, text):
+    if not LLM_CACHE_PATH or not text:
+        return
+    try:
+        db = _llm_cache_db()
+        db.execute("INSERT OR REPLACE INTO KV (key, text, ts) VALUES (?, ?, ?)", (key, text, int(time.time())))
+        db.commit()
+    except sqlite3.Error as e:
+        logger.warning("LLM cache write failed: %s", e)
+
+# Upper bound on concurrent LLM requests, to stay within provider rate limits
+_LLM_SEM = asyncio.Semaphore(int(os.environ.get("LLM_CONCURRENCY", "4")))
+
+# Output budget per generated scene; batched scene requests are split so
+# that their combined budget stays within BATCH_MAX_OUTPUT_TOKENS
+SCENE_MAX_OUTPUT_TOKENS = 3500
+# Deadline for generating one scene, including retries; callers waiting on a
+# scene another task is generating wait just as long before generating it themselves
+SCENE_TIMEOUT = 90
+BATCH_SCENE_MODEL = os.environ.get("BATCH_SCENE_MODEL", "gpt-4o")
+BATCH_MAX_OUTPUT_TOKENS = int(os.environ.get("BATCH_MAX_OUTPUT_TOKENS", "16000"))
+
+# A stalled request is abandoned after LLM_ATTEMPT_TIMEOUT seconds without a
+# first token and retried, up to LLM_MAX_RETRIES times within the caller's
+# overall timeout
+LLM_ATTEMPT_TIMEOUT = float(os.environ.get("LLM_ATTEMPT_TIMEOUT", "20"))
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "3"))
+
+async def _create_completion(client, model, messages, *, parse, timeout=None, **generation_config):
+    """
+    Run a chat completion and return parse() of the message text, consulting
+    the persistent response cache first. Only responses that finished
+    normally and parsed are cached, so failures are retried on the next run.
+    timeout is the total deadline across all attempts.
+    """
+    key = _llm_cache_key(model, generation_config, messages)
+    cached = _llm_cache_get(key)
+    if cached:
+        try:
+            return parse(cached)
+        except Exception as e:
+            logger.warning("Ignoring unparseable cached LLM response: %s", e)
+    
+    request = dict(generation_config)
+    # Take the concurrency slot before the deadline starts, so time spent
+    # queued behind other requests doesn't count against it
+    async with _LLM_SEM:
+        if timeout is None:
+            text, finish_reason = await _stream_completion(client, model, messages, request)
+        else:
+            request["timeout"] = timeout
+            text, finish_reason = await _complete_within_deadline(client, model, messages, request, timeout)
+    result = parse(text)
+    if finish_reason == "stop":
+        _llm_cache_put(key, text)
+    return result
+
+async def _complete_within_deadline(client, model, messages, request, timeout):
+    """Retry requests that stall before their first token until the deadline passes"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    for attempt in range(LLM_MAX_RETRIES):
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+        try:
+            return await asyncio.wait_for(
+                _stream_completion(client, model, messages, request, min(LLM_ATTEMPT_TIMEOUT, remaining)),
+                timeout=remaining
+            )
+        except asyncio.TimeoutError:
+            logger.warning("LLM request timed out (attempt %s of %s)", attempt + 1, LLM_MAX_RETRIES)
+    raise asyncio.TimeoutError(f"LLM request did not complete within {timeout}s")
+
+# Errors worth retrying: rate limiting, provider-side failures and dropped connections
+_TRANSIENT_LLM_ERRORS = (RateLimitError, InternalServerError, APIConnectionError)
+
+def _async_retry(attempts=4, base=0.5, jitter=True):
+    """Retry a coroutine on transient LLM errors with exponential backoff"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            for attempt in range(attempts):
+                try:
+                    return await func(*args, **kwargs)
+                except _TRANSIENT_LLM_ERRORS as e:
+                    if attempt == attempts - 1:
+                        raise
+                    delay = base * 2 ** attempt + (random.uniform(0, base) if jitter else 0)
+                    logger.warning("LLM request failed (%s), retrying in %.1fs", e, delay)
+                    await asyncio.sleep(delay)
+        return wrapper
+    return decorator
+
+@_async_retry(attempts=4, base=0.5)
+async def _stream_completion(client, model, messages, request, first_chunk_timeout=None):
+    """
+    Stream one chat completion, accumulating the deltas as they arrive.
+    Returns the text and the finish reason.
+    """
+    # Only the wait for the first token is bounded per attempt; once the
+    # response is streaming it runs until the caller's overall deadline
+    # (SCENE_TIMEOUT for a scene), which cancels it if it is still going
+    opening = _open_stream(client, model, messages, request)
+    if first_chunk_timeout is not None:
+        opening = asyncio.wait_for(opening, timeout=first_chunk_timeout)
+    stream, chunks, chunk = await opening
+    # Close the stream however it ends, so an abandoned response doesn't
+    # hold a pooled connection until it is garbage collected
+    try:
+        parts = []
+        finish_reason = None
+        while chunk is not None:
+            if chunk.choices:
+                choice = chunk.choices[0]
+                if choice.delta.content:
+                    parts.append(choice.delta.content)
+                finish_reason = choice.finish_reason or finish_reason
+            chunk = await anext(chunks, None)
+    finally:
+        await stream.close()
+    return "".join(parts), finish_reason
+
+async def _open_stream(client, model, messages, request):
+    """Start a streamed completion and wait for its first chunk"""
+    stream = await client.chat.completions.create(model=model, messages=messages, stream=True, **request)
+    try:
+        chunks = aiter(stream)
+        return stream, chunks, await anext(chunks, None)
+    except BaseException:
+        # Includes cancellation by the first-chunk timeout
+        await stream.close()
+        raise
+
+def get_openai_client():
+    """Return the process-wide OpenAI client for the configured API key"""
+    return _openai_client_for_key(os.environ.get("OPENAI_API_KEY", "your-openai-api-key"))
+
+@functools.lru_cache(maxsize=8)
+def _openai_client_for_key(api_key):
+    # One client per key lets every request reuse its connection pool.
+    # _async_retry already retries transient errors, so the SDK's own
+    # retries are disabled rather than multiplying with it
+    return AsyncOpenAI(api_key=api_key, max_retries=0)
+
 async def generate_visual_novel(book_analysis: dict) -> dict:
     """
     Generate a visual novel script with branching paths from the book analysis
@@ -39,13 +295,15 @@ async def generate_visual_novel(book_analysis: dict) -> dict:
     try:
         # Store book analysis in global cache for future reference
         STORY_CACHE["book_analysis"] = book_analysis
-        STORY_CACHE["generated_scenes"] = {}
+        STORY_CACHE["generated_scenes"] = LRUCache(SCENE_CACHE_SIZE)
+        STORY_CACHE["scene_by_hash"] = LRUCache(SCENE_CACHE_SIZE)
         STORY_CACHE["scene_graph"] = {}
-        STORY_CACHE["in_progress_scenes"] = set()
+        STORY_CACHE["in_progress_scenes"] = {}
+        STORY_CACHE["book_context"] = None
+        STORY_CACHE["char_index"] = None
         
-        # Initialize OpenAI client
-        api_key = os.environ.get("OPENAI_API_KEY", "your-openai-api-key")
-        client = AsyncOpenAI(api_key=api_key)
+        # Get the shared OpenAI client
+        client = get_openai_client()
         
         # Use the optimized approach
         script_data = await generate_initial_script(book_analysis, client)
@@ -62,7 +320,7 @@ async def generate_visual_novel(book_analysis: dict) -> dict:
         return script_data
         
     except Exception as e:
-        print(f"Error generating script: {str(e)}")
+        logger.error("Error generating script: %s", e)
         return await generate_placeholder_script(book_analysis)
 
 def update_scene_graph(script_data):
@@ -78,45 +336,54 @@ def update_scene_graph(script_data):
         
         # Create entry in scene graph if not exists
         if scene_id not in scene_graph:
-            scene_graph[scene_id] = {
-                "outgoing": [],
-                "incoming": []
-            }
+            scene_graph[scene_id] = _new_scene_graph_node()
+        node = scene_graph[scene_id]
         
         # Find all outgoing connections from this scene
         for dialogue in scene["dialogue"]:
             if "choices" in dialogue:
                 for choice in dialogue["choices"]:
                     if "nextScene" in choice and choice["nextScene"] != "exit":
+                        target_id = choice["nextScene"]
+                        
                         # Add outgoing connection
-                        if choice["nextScene"] not in [c["target"] for c in scene_graph[scene_id]["outgoing"]]:
-                            scene_graph[scene_id]["outgoing"].append({
-                                "target": choice["nextScene"],
-                                "text": choice["text"]
-                            })
+                        if target_id not in node["outgoing"]:
+                            node["outgoing"][target_id] = choice["text"]
                         
                         # Add target scene to graph if not exists
-                        if choice["nextScene"] not in scene_graph:
-                            scene_graph[choice["nextScene"]] = {
-                                "outgoing": [],
-                                "incoming": []
-                            }
+                        if target_id not in scene_graph:
+                            scene_graph[target_id] = _new_scene_graph_node()
+                        target = scene_graph[target_id]
                         
                         # Add incoming connection to target
-                        if scene_id not in [c["source"] for c in scene_graph[choice["nextScene"]]["incoming"]]:
-                            scene_graph[choice["nextScene"]]["incoming"].append({
-                                "source": scene_id,
-                                "text": choice["text"]
-                            })
+                        if scene_id not in target["incoming"]:
+                            target["incoming"][scene_id] = choice["text"]
     
     # Update the global cache
     STORY_CACHE["scene_graph"] = scene_graph
 
+def _new_scene_graph_node():
+    """Empty scene graph entry; edges map the other scene's id to the choice text"""
+    return {
+        "outgoing": {},
+        "incoming": {}
+    }
+
+def scene_graph_to_json(scene_graph):
+    """Convert the scene graph to its list-of-edges form for serialization"""
+    return {
+        scene_id: {
+            "outgoing": [{"target": target, "text": text} for target, text in node["outgoing"].items()],
+            "incoming": [{"source": source, "text": text} for source, text in node["incoming"].items()]
+        }
+        for scene_id, node in scene_graph.items()
+    }
+
 async def generate_initial_script(book_analysis: dict, client) -> dict:
     """
     Generate the initial visual novel script with the first set of scenes
     """
-    print("Generating initial script skeleton...")
+    logger.info("Generating initial script skeleton...")
     
     # Create an outline for the first 5 scenes
     outline = await generate_script_outline(book_analysis, client, scene_limit=5)
@@ -127,31 +394,50 @@ async def generate_initial_script(book_analysis: dict, client) -> dict:
         "scenes": []
     }
     
-    # Generate the first 5 scenes based on the outline
-    initial_scenes = []
-    
-    # Process all planned scenes in parallel
-    tasks = []
-    for scene_outline in outline.get("scenes", [])[:5]:
-        tasks.append(generate_scene_from_outline(scene_outline, book_analysis, client))
-    
-    # Wait for all scenes to complete
-    initial_scenes = await asyncio.gather(*tasks)
+    # Generate the first 5 scenes based on the outline, batching several
+    # scenes into each request
+    scene_outlines = outline.scenes[:5]
+    initial_scenes = await generate_scenes_batch(scene_outlines, book_analysis, client)
     
     # Add scenes to the script
     for scene in initial_scenes:
         if scene:  # Only add successfully generated scenes
             vn_script["scenes"].append(scene)
     
-    print(f"Generated initial script with {len(vn_script['scenes'])} scenes")
+    logger.info("Generated initial script with %s scenes", len(vn_script['scenes']))
     return vn_script
 
-async def generate_script_outline(book_analysis: dict, client, scene_limit=10) -> dict:
-    """Generate an outline for the script with planned scenes"""
+def _build_character_index(book_analysis):
+    """Index characters by lowercased id and name"""
+    char_index = {}
+    for char in book_analysis.get("characters", []):
+        for key in (char.get("id"), char.get("name")):
+            if key:
+                char_index.setdefault(key.lower(), char)
+    return char_index
+
+def _get_character_index(book_analysis):
+    """Return the character index for book_analysis, building it once per book"""
+    cached = STORY_CACHE.get("char_index")
+    if cached and cached[0] is book_analysis:
+        return cached[1]
+    
+    char_index = _build_character_index(book_analysis)
+    STORY_CACHE["char_index"] = (book_analysis, char_index)
+    return char_index
+
+def _build_book_context(book_analysis):
+    """
+    Render the book-level prompt context once per book analysis.
+    Returns (character_info, branching_info, key_points, themes)
+    """
+    cached = STORY_CACHE.get("book_context")
+    if cached and cached[0] is book_analysis:
+        return cached[1]
     
     # Extract key elements from the book analysis
     characters = book_analysis.get("characters", [])
-    character_info = ""
+    char_parts = []
     
     # Create detailed character information for more authentic portrayal
     for char in characters[:7]:  # Limit to 7 important characters
@@ -159,29 +445,121 @@ async def generate_script_outline(book_analysis: dict, client, scene_limit=10) -
         speech = char.get("speech_patterns", "")
         motivations = char.get("motivations", "")
         
-        character_info += f"""
+        char_parts.append(f"""
         - {char.get('name', 'Unknown')}: {char.get('role', 'A character')}
           * Description: {char.get('description', 'No description')}
           * Personality: {personality}
           * Speech patterns: {speech}
           * Motivations: {motivations}
           * Relationships: {char.get('relationships', 'Unknown')}
-        """
+        """)
+    character_info = "".join(char_parts)
     
     # Extract plot information
-    plot_summary = book_analysis.get("plot", {}).get("summary", "A story with characters and challenges.")
-    central_conflict = book_analysis.get("plot", {}).get("central_conflict", "A conflict that drives the narrative")
     key_points = book_analysis.get("plot", {}).get("key_points", [])
     branching_points = book_analysis.get("plot", {}).get("branching_points", [])
     
     # Create branching point information
-    branching_info = ""
+    branching_parts = []
     for i, bp in enumerate(branching_points[:5]):  # Limit to 5 branching points
         options = ", ".join([f'"{opt}"' for opt in bp.get("options", [])])
-        branching_info += f"""
+        branching_parts.append(f"""
         - Choice point {i+1}: {bp.get('description', 'A decision')}
           * Options: {options}
-        """
+        """)
+    branching_info = "".join(branching_parts)
+    
+    context = (
+        character_info,
+        branching_info,
+        ', '.join(key_points[:8]),
+        ', '.join(book_analysis.get('themes', ['adventure'])[:3])
+    )
+    STORY_CACHE["book_context"] = (book_analysis, context)
+    return context
+
+class SceneOutline(BaseModel):
+    """A planned scene, as produced by the script outline"""
+    model_config = {"frozen": True}
+    
+    id: Optional[str] = None
+    description: str = "A scene in the story"
+    characters: List[str] = []
+    setting: str = "An important location"
+    atmosphere: str = "Creates a specific mood"
+    dialogue_count: Optional[int] = None
+    connects_to: List[str] = []
+    
+    @field_validator("id", mode="before")
+    @classmethod
+    def _id_to_str(cls, value):
+        return value if value is None else str(value)
+    
+    @field_validator("description", "setting", "atmosphere", mode="before")
+    @classmethod
+    def _loose_text(cls, value, info: ValidationInfo):
+        if value is None:
+            return cls.model_fields[info.field_name].default
+        return str(value)
+    
+    @field_validator("characters", "connects_to", mode="before")
+    @classmethod
+    def _loose_id_list(cls, value):
+        # Accept null, a single ID, or IDs that aren't strings
+        if value is None:
+            return []
+        if not isinstance(value, list):
+            value = [value]
+        return [str(item) for item in value if item is not None]
+    
+    @field_validator("dialogue_count", mode="before")
+    @classmethod
+    def _loose_dialogue_count(cls, value):
+        # Models sometimes echo the "6-10" range from the prompt; treat that as unset
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+
+class ScriptOutline(BaseModel):
+    model_config = {"frozen": True}
+    
+    scenes: List[SceneOutline] = []
+    
+    @field_validator("scenes", mode="before")
+    @classmethod
+    def _none_to_empty(cls, value):
+        return [] if value is None else value
+
+# Basic outline used when outline generation fails
+_FALLBACK_OUTLINE = {
+    "scenes": [
+        {
+            "id": "scene_1",
+            "description": "Introduction to the story and main characters",
+            "characters": ["protagonist"],
+            "setting": "The main setting of the story",
+            "atmosphere": "Establishes the tone of the narrative",
+            "dialogue_count": 8,
+            "connects_to": ["scene_2a", "scene_2b"]
+        },
+        {
+            "id": "scene_2a",
+            "description": "The protagonist takes an active approach",
+            "characters": ["protagonist", "supporting"],
+            "setting": "A location that presents challenges",
+            "atmosphere": "Tense and action-oriented",
+            "dialogue_count": 7,
+            "connects_to": ["scene_3"]
+        }
+    ]
+}
+
+def _build_outline_prompt(book_analysis: dict, scene_limit: int) -> str:
+    """Build the provider-independent prompt for the script outline"""
+    character_info, branching_info, key_points, themes = _build_book_context(book_analysis)
+    plot_summary = book_analysis.get("plot", {}).get("summary", "A story with characters and challenges.")
+    central_conflict = book_analysis.get("plot", {}).get("central_conflict", "A conflict that drives the narrative")
     
     # Create a prompt that emphasizes slower story development and rich detail
     prompt = f"""
@@ -199,12 +577,12 @@ async def generate_script_outline(book_analysis: dict, client, scene_limit=10) -
     {central_conflict}
     
     KEY PLOT POINTS:
-    {', '.join(key_points[:8])}
+    {key_points}
     
     POTENTIAL BRANCHING POINTS:
     {branching_info}
     
-    THEMES: {', '.join(book_analysis.get('themes', ['adventure'])[:3])}
+    THEMES: {themes}
     TONE: {book_analysis.get('tone', 'neutral')}
     
     CRITICAL REQUIREMENTS FOR VISUAL NOVEL ADAPTATION:
@@ -240,10 +618,16 @@ async def generate_script_outline(book_analysis: dict, client, scene_limit=10) -
       ]
     }}
     """
+    return prompt
+
+async def generate_script_outline(book_analysis: dict, client, scene_limit=10) -> ScriptOutline:
+    """Generate an outline for the script with planned scenes"""
+    prompt = _build_outline_prompt(book_analysis, scene_limit)
     
     try:
-        # Generate the outline
-        response = await client.chat.completions.create(
+        # Generate and parse the outline
+        outline_data = await _create_completion(
+            client,
             model="gpt-4-turbo",
             response_format={"type": "json_object"},
             messages=[
@@ -251,117 +635,247 @@ async def generate_script_outline(book_analysis: dict, client, scene_limit=10) -
                 {"role": "user", "content": prompt}
             ],
             temperature=0.7,
-            max_tokens=2500
+            max_tokens=2500,
+            parse=ScriptOutline.model_validate_json
         )
         
-        # Parse the response
-        outline_text = response.choices[0].message.content
-        outline_data = json.loads(outline_text)
-        
-        print(f"Generated script outline with {len(outline_data.get('scenes', []))} planned scenes")
+        logger.info("Generated script outline with %s planned scenes", len(outline_data.scenes))
         return outline_data
         
     except Exception as e:
-        print(f"Error generating script outline: {str(e)}")
+        logger.error("Error generating script outline: %s", e)
         # Return a basic outline if failed
-        return {
-            "scenes": [
-                {
-                    "id": "scene_1",
-                    "description": "Introduction to the story and main characters",
-                    "characters": ["protagonist"],
-                    "setting": "The main setting of the story",
-                    "atmosphere": "Establishes the tone of the narrative",
-                    "dialogue_count": 8,
-                    "connects_to": ["scene_2a", "scene_2b"]
-                },
-                {
-                    "id": "scene_2a",
-                    "description": "The protagonist takes an active approach",
-                    "characters": ["protagonist", "supporting"],
-                    "setting": "A location that presents challenges",
-                    "atmosphere": "Tense and action-oriented",
-                    "dialogue_count": 7,
-                    "connects_to": ["scene_3"]
-                }
-            ]
-        }
+        return ScriptOutline.model_validate(_FALLBACK_OUTLINE)
 
-async def generate_scene_from_outline(scene_outline, book_analysis, client):
-    """Generate a full scene from its outline description"""
-    scene_id = scene_outline.get("id", f"scene_{random.randint(1000, 9999)}")
-    
-    # Prevent duplicate generation
-    if scene_id in STORY_CACHE["generated_scenes"]:
-        print(f"Scene {scene_id} already exists in cache, using cached version")
-        return STORY_CACHE["generated_scenes"][scene_id]
-        
-    # Check if already being generated
-    if scene_id in STORY_CACHE["in_progress_scenes"]:
-        print(f"Scene {scene_id} is already being generated, waiting...")
-        # Wait for it to appear in cache (with timeout)
-        for _ in range(30):  # 30 second timeout
-            await asyncio.sleep(1)
-            if scene_id in STORY_CACHE["generated_scenes"]:
-                return STORY_CACHE["generated_scenes"][scene_id]
-        
-        print(f"Timed out waiting for scene {scene_id}, will generate now")
-    
-    # Mark as in progress
-    STORY_CACHE["in_progress_scenes"].add(scene_id)
+async def generate_scenes_batch(scene_outlines, book_analysis, client):
+    """
+    Generate several scenes with as few LLM requests as possible.
+    Scenes missing or malformed in a batched response are regenerated
+    one at a time with generate_scene_from_outline.
+    """
+    # Outlines identical to ones already generated don't need a request, and
+    # identical outlines within this call are requested only once
+    generated = {}
+    pending = []
+    duplicates = []
+    first_id_by_hash = {}
+    for scene_outline in scene_outlines:
+        scene = _scene_for_identical_outline(scene_outline.id, scene_outline)
+        if scene:
+            generated[scene_outline.id] = scene
+            continue
+        outline_hash = _outline_hash(scene_outline)
+        if outline_hash in first_id_by_hash:
+            duplicates.append((scene_outline.id, first_id_by_hash[outline_hash]))
+        else:
+            first_id_by_hash[outline_hash] = scene_outline.id
+            pending.append(scene_outline)
+    
+    # Split into as few batches as the output budget allows, sized evenly so
+    # no batch is left with a lone scene
+    max_batch_size = max(1, BATCH_MAX_OUTPUT_TOKENS // SCENE_MAX_OUTPUT_TOKENS)
+    batch_count = math.ceil(len(pending) / max_batch_size)
+    batch_size = math.ceil(len(pending) / batch_count) if batch_count else 1
+    batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+    batch_results = await asyncio.gather(*(
+        _generate_scene_batch(batch, book_analysis, client) for batch in batches
+    ))
+    
+    # Anything the batched requests didn't produce goes through the per-scene path
+    for result in batch_results:
+        generated.update(result)
+    
+    missing = [scene_outline for scene_outline in pending if not generated.get(scene_outline.id)]
+    if missing:
+        logger.warning("Falling back to per-scene generation for %s scenes", len(missing))
+        fallback_scenes = await generate_all_scenes(missing, book_analysis, client)
+        for scene_outline, scene in zip(missing, fallback_scenes):
+            generated[scene_outline.id] = scene
+    
+    for scene_id, first_id in duplicates:
+        generated[scene_id] = _copy_scene_as(scene_id, generated[first_id])
+    
+    return [generated[scene_outline.id] for scene_outline in scene_outlines]
+
+async def generate_all_scenes(scene_outlines, book_analysis, client, max_concurrency=8):
+    """
+    Generate scenes one request each, running up to max_concurrency at a time.
+    A scene whose generation raises is replaced with a placeholder.
+    """
+    scene_outlines = [o if isinstance(o, SceneOutline) else SceneOutline.model_validate(o) for o in scene_outlines]
+    sem = asyncio.Semaphore(max_concurrency)
+    
+    async def _one(scene_outline):
+        async with sem:
+            return await generate_scene_from_outline(scene_outline, book_analysis, client)
+    
+    results = await asyncio.gather(*(_one(o) for o in scene_outlines), return_exceptions=True)
+    
+    scenes = []
+    for scene_outline, result in zip(scene_outlines, results):
+        if isinstance(result, Exception):
+            logger.error("Error generating scene %s: %s", scene_outline.id, result)
+            result = create_placeholder_scene(scene_outline.id or _random_scene_id(), scene_outline, book_analysis)
+        scenes.append(result)
+    return scenes
+
+async def _generate_scene_batch(scene_outlines, book_analysis, client):
+    """Generate one batch of scenes with a single request, returning {scene_id: scene}"""
+    if not scene_outlines:
+        return {}
+    
+    scene_sections = []
+    for i, scene_outline in enumerate(scene_outlines):
+        connections = scene_outline.connects_to
+        scene_sections.append(f"""
+        SCENE {i + 1}:
+        - ID: {scene_outline.id}
+        - Description: {scene_outline.description}
+        - Setting: {scene_outline.setting}
+        - Atmosphere: {scene_outline.atmosphere}
+        - Dialogue exchanges: {scene_outline.dialogue_count or 8}
+        - Connects to: {", ".join(connections) if connections else "None specified"}
+        - Characters present:
+        {_build_scene_character_info(scene_outline, book_analysis)}
+        """)
     
-    try:
-        # Get detailed information about characters in this scene
-        characters = []
-        for char_id in scene_outline.get("characters", []):
-            # Find the character in book analysis
-            char_data = next((c for c in book_analysis.get("characters", []) if c.get("id") == char_id or c.get("name").lower() == char_id.lower()), None)
-            if char_data:
-                characters.append(char_data)
-        
-        # Create character information for the prompt
-        character_info = ""
-        for char in characters:
-            personality = char.get("personality", "")
-            speech = char.get("speech_patterns", "")
-            character_info += f"""
-            - {char.get('name', 'Unknown')}:
-              * Role: {char.get('role', 'A character in the story')}
-              * Description: {char.get('description', 'No description')}
-              * Personality: {personality}
-              * Speech patterns: {speech}
-              * Motivations: {char.get('motivations', 'Unknown')}
-            """
-            
-        # If no characters were found, add a note
-        if not character_info:
-            character_info = "No specific characters identified for this scene."
+    prompt = f"""
+        Generate {len(scene_outlines)} detailed scenes for a visual novel with rich dialogue and atmosphere.
         
-        # Get connections to other scenes
-        connections = scene_outline.get("connects_to", [])
-        connections_info = ", ".join(connections) if connections else "None specified"
+        {"".join(scene_sections)}
         
-        # Calculate desired dialogue count (6-10 lines by default)
-        dialogue_count = scene_outline.get("dialogue_count", random.randint(6, 10))
+        IMPORTANT REQUIREMENTS:
+        1. CREATE EXACTLY THE REQUESTED NUMBER OF DIALOGUE EXCHANGES for each scene, for a slow, immersive pace
+        2. WRITE RICH, ENGAGING TEXT with detailed descriptions and natural dialogue
+        3. MAINTAIN CHARACTER VOICE - each character should speak in their distinctive pattern
+        4. INCLUDE DESCRIPTIVE NARRATION between dialogue to establish mood and setting
+        5. CREATE MEANINGFUL CHOICES that connect to each scene's specified scenes
+        6. IF A CRITICAL PLOT ELEMENT (like a weapon, creature, or revelation) appears, PROPERLY FORESHADOW it
         
-        # Create a prompt for generating this specific scene
-        prompt = f"""
-        Generate a detailed scene for a visual novel with rich dialogue and atmosphere.
+        FORMAT:
+        Return a JSON object keyed by the scene IDs above, with one entry per scene:
+        {{
+          "scene_id": {{
+              "id": "scene_id",
+              "background": "Detailed description of the setting and visuals",
+              "characters": [
+                {{ "id": "character_id", "image": "Detailed character appearance" }}
+              ],
+              "dialogue": [
+                {{
+                  "speaker": "Character Name",
+                  "text": "Rich, detailed dialogue that feels natural and reflects character's voice",
+                  "character": "character_id" (optional)
+                }},
+                {{
+                  "speaker": "Narrator",
+                  "text": "Descriptive narration that establishes mood, setting, and character emotions"
+                }},
+                ...
+                {{
+                  "speaker": "Character Name",
+                  "text": "Final choice prompt with depth and consequence",
+                  "character": "character_id" (optional),
+                  "choices": [
+                    {{ "text": "Meaningful choice with clear implication", "nextScene": "target_scene_id" }}
+                  ]
+                }}
+              ]
+          }},
+          ...
+        }}
         
-        SCENE INFORMATION:
-        - ID: {scene_id}
-        - Description: {scene_outline.get('description', 'A scene in the story')}
-        - Setting: {scene_outline.get('setting', 'An important location')}
-        - Atmosphere: {scene_outline.get('atmosphere', 'Creates a specific mood')}
+        FOCUS ON QUALITY: Create dialogue that is engaging, natural, and reflects the character's voice.
+        """
+    
+    try:
+        batch_data = await _create_completion(
+            client,
+            model=BATCH_SCENE_MODEL,
+            response_format={"type": "json_object"},
+            messages=[
+                {"role": "system", "content": "You are a master writer of interactive fiction, specializing in creating immersive, literary-quality scenes with authentic dialogue."},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=0.8,
+            max_tokens=SCENE_MAX_OUTPUT_TOKENS * len(scene_outlines),
+            # Output streams at a roughly constant rate, so allow each scene
+            # in the batch as long as a scene generated on its own
+            timeout=SCENE_TIMEOUT * len(scene_outlines),
+            parse=_parse_scene_batch
+        )
+    except Exception as e:
+        logger.error("Error generating scene batch: %s", e)
+        return {}
+    
+    # Demultiplex by scene ID, keeping only requested scenes that look valid
+    requested = {scene_outline.id: scene_outline for scene_outline in scene_outlines}
+    scenes = {}
+    for scene_id, scene_data in batch_data.items():
+        if scene_id not in requested or not isinstance(scene_data, dict):
+            continue
+        scene_data["id"] = scene_id
+        if not isinstance(scene_data.get("dialogue"), list) or not scene_data["dialogue"]:
+            continue
+        scenes[scene_id] = scene_data
+        _cache_scene(scene_id, requested[scene_id], scene_data)
+    
+    logger.info("Generated %s of %s scenes in one batch", len(scenes), len(scene_outlines))
+    return scenes
+
+def _parse_scene_batch(batch_text):
+    """Parse a batched scene response into a {scene_id: scene} mapping"""
+    batch_data = json_loads(batch_text)
+    if not isinstance(batch_data, dict):
+        raise ValueError("Scene batch response is not a JSON object")
+    # Models occasionally nest the mapping under "scenes"; accept that too
+    if isinstance(batch_data.get("scenes"), (dict, list)):
+        batch_data = batch_data["scenes"]
+    if isinstance(batch_data, list):
+        batch_data = {scene_data.get("id"): scene_data for scene_data in batch_data if isinstance(scene_data, dict)}
+    return batch_data
+
+def _build_scene_character_info(scene_outline, book_analysis):
+    """Describe the characters present in a scene for a scene prompt"""
+    # Get detailed information about characters in this scene
+    characters = []
+    char_index = _get_character_index(book_analysis)
+    for char_id in scene_outline.characters:
+        # Find the character in book analysis
+        char_data = char_index.get(char_id.lower())
+        if char_data:
+            characters.append(char_data)
+    
+    # Create character information for the prompt
+    char_parts = []
+    for char in characters:
+        personality = char.get("personality", "")
+        speech = char.get("speech_patterns", "")
+        char_parts.append(f"""
+        - {char.get('name', 'Unknown')}:
+          * Role: {char.get('role', 'A character in the story')}
+          * Description: {char.get('description', 'No description')}
+          * Personality: {personality}
+          * Speech patterns: {speech}
+          * Motivations: {char.get('motivations', 'Unknown')}
+        """)
+    character_info = "".join(char_parts)
         
-        CHARACTERS PRESENT:
-        {character_info}
+    # If no characters were found, add a note
+    if not character_info:
+        character_info = "No specific characters identified for this scene."
+    
+    return character_info
+
+# Instructions and output format shared by every single-scene request. Kept
+# in the system message so the identical prefix is eligible for provider-side
+# prompt caching; the user message carries only the scene-specific details.
+_SCENE_SYSTEM_PROMPT = """You are a master writer of interactive fiction, specializing in creating immersive, literary-quality scenes with authentic dialogue.
         
-        CONNECTIONS:
-        This scene should connect to these scenes: {connections_info}
+        You will be asked to generate one scene for a visual novel with rich dialogue and atmosphere.
         
         IMPORTANT REQUIREMENTS:
-        1. CREATE EXACTLY {dialogue_count} DIALOGUE EXCHANGES (not just lines) for a slow, immersive pace
+        1. CREATE EXACTLY THE REQUESTED NUMBER OF DIALOGUE EXCHANGES (not just lines) for a slow, immersive pace
         2. WRITE RICH, ENGAGING TEXT with detailed descriptions and natural dialogue
         3. MAINTAIN CHARACTER VOICE - each character should speak in their distinctive pattern
         4. INCLUDE DESCRIPTIVE NARRATION between dialogue to establish mood and setting
@@ -369,99 +883,200 @@ async def generate_scene_from_outline(scene_outline, book_analysis, client):
         6. IF A CRITICAL PLOT ELEMENT (like a weapon, creature, or revelation) appears, PROPERLY FORESHADOW it
         
         FORMAT:
-        Return a JSON object for this single scene following this exact structure:
-        {{
-          "id": "{scene_id}",
+        Return a JSON object for the single scene following this exact structure:
+        {
+          "id": "the scene ID given",
           "background": "Detailed description of the setting and visuals",
           "characters": [
-            {{ "id": "character_id", "image": "Detailed character appearance" }}
+            { "id": "character_id", "image": "Detailed character appearance" }
           ],
           "dialogue": [
-            {{
+            {
               "speaker": "Character Name",
               "text": "Rich, detailed dialogue that feels natural and reflects character's voice",
               "character": "character_id" (optional)
-            }},
-            {{
+            },
+            {
               "speaker": "Narrator", 
               "text": "Descriptive narration that establishes mood, setting, and character emotions"
-            }},
-            ... ({dialogue_count} total dialogue entries)
-            {{
+            },
+            ... (the requested number of dialogue entries in total)
+            {
               "speaker": "Character Name",
               "text": "Final choice prompt with depth and consequence",
               "character": "character_id" (optional),
               "choices": [
-                {{ "text": "Meaningful choice with clear implication", "nextScene": "target_scene_id" }}
+                { "text": "Meaningful choice with clear implication", "nextScene": "target_scene_id" }
               ]
-            }}
+            }
           ]
-        }}
+        }
         
         FOCUS ON QUALITY: Create dialogue that is engaging, natural, and reflects the character's voice.
         """
+
+# Prompt for a single scene; only the placeholders change between calls
+_SCENE_PROMPT_TEMPLATE = """
+        SCENE INFORMATION:
+        - ID: {scene_id}
+        - Description: {description}
+        - Setting: {setting}
+        - Atmosphere: {atmosphere}
+        - Dialogue exchanges: {dialogue_count}
+        
+        CHARACTERS PRESENT:
+        {character_info}
         
-        # Generate the scene
-        response = await client.chat.completions.create(
+        CONNECTIONS:
+        This scene should connect to these scenes: {connections_info}
+        """
+
+def _random_scene_id():
+    """Make an ID for a scene whose outline didn't name one"""
+    # getrandbits skips randint's argument handling; the modulo bias is irrelevant here
+    return f"scene_{1000 + random.getrandbits(14) % 9000}"
+
+def _stable_dialogue_count(scene_id, low, high):
+    """
+    Pick a dialogue count in [low, high] from the scene ID, so the prompt,
+    and with it the LLM cache key, is the same on every run
+    """
+    return low + zlib.crc32(scene_id.encode()) % (high - low + 1)
+
+def _outline_hash(scene_outline):
+    """Hash an outline's content, ignoring its scene ID"""
+    content = json.dumps(scene_outline.model_dump(exclude={"id"}), sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+def _cache_scene(scene_id, scene_outline, scene_data, reuse_identical=True):
+    """
+    Store a generated scene under its ID and, if it may be reused for
+    identical outlines, under its outline's content hash
+    """
+    STORY_CACHE["generated_scenes"][scene_id] = scene_data
+    if reuse_identical:
+        STORY_CACHE["scene_by_hash"][_outline_hash(scene_outline)] = scene_data
+
+def _scene_for_identical_outline(scene_id, scene_outline):
+    """
+    Reuse a scene generated from an outline with the same content under
+    another ID, caching a copy as scene_id. Returns None if there is none.
+    """
+    cached = STORY_CACHE["scene_by_hash"].get(_outline_hash(scene_outline))
+    if cached is None:
+        return None
+    return _copy_scene_as(scene_id, cached)
+
+def _copy_scene_as(scene_id, scene_data):
+    """Cache and return a copy of a generated scene under another ID"""
+    scene_data = copy.deepcopy(scene_data)
+    scene_data["id"] = scene_id
+    STORY_CACHE["generated_scenes"][scene_id] = scene_data
+    return scene_data
+
+async def generate_scene_from_outline(scene_outline, book_analysis, client, reuse_identical=True):
+    """
+    Generate a full scene from its outline description. Pass
+    reuse_identical=False for templated outlines, whose identical content
+    doesn't mean the scenes should be identical.
+    """
+    if isinstance(scene_outline, dict):
+        scene_outline = SceneOutline.model_validate(scene_outline)
+    scene_id = scene_outline.id or _random_scene_id()
+    
+    # Prevent duplicate generation
+    if scene_id in STORY_CACHE["generated_scenes"]:
+        logger.debug("Scene %s already exists in cache, using cached version", scene_id)
+        return STORY_CACHE["generated_scenes"][scene_id]
+    
+    # Reuse a scene generated from identical outline content
+    scene_data = _scene_for_identical_outline(scene_id, scene_outline) if reuse_identical else None
+    if scene_data:
+        logger.debug("Scene %s matches an already generated outline, reusing it", scene_id)
+        return scene_data
+        
+    # Check if already being generated
+    in_progress = STORY_CACHE["in_progress_scenes"].get(scene_id)
+    if in_progress:
+        logger.debug("Scene %s is already being generated, waiting...", scene_id)
+        # Wait to be woken when it lands in the cache (with timeout)
+        try:
+            await asyncio.wait_for(in_progress.wait(), timeout=SCENE_TIMEOUT)
+            if scene_id in STORY_CACHE["generated_scenes"]:
+                return STORY_CACHE["generated_scenes"][scene_id]
+        except asyncio.TimeoutError:
+            logger.warning("Timed out waiting for scene %s, will generate now", scene_id)
+    
+    # Mark as in progress
+    done = asyncio.Event()
+    STORY_CACHE["in_progress_scenes"][scene_id] = done
+    
+    try:
+        return await _generate_scene(scene_id, scene_outline, book_analysis, client, reuse_identical)
+    finally:
+        # Wake anyone waiting on this scene
+        done.set()
+        if STORY_CACHE["in_progress_scenes"].get(scene_id) is done:
+            del STORY_CACHE["in_progress_scenes"][scene_id]
+
+def _parse_scene(scene_text):
+    """Parse a single-scene response, repairing malformed JSON if possible"""
+    try:
+        scene_data = json_loads(scene_text)
+    except json.JSONDecodeError as e:
+        logger.warning("Error parsing scene JSON: %s", e)
+        scene_data = json_loads(attempt_json_repair(scene_text))
+    if not isinstance(scene_data, dict):
+        raise ValueError("Scene response is not a JSON object")
+    return scene_data
+
+async def _generate_scene(scene_id, scene_outline, book_analysis, client, reuse_identical=True):
+    """Generate and cache a scene, falling back to a placeholder on failure"""
+    try:
+        # Describe the characters in this scene
+        character_info = _build_scene_character_info(scene_outline, book_analysis)
+        
+        # Get connections to other scenes
+        connections = scene_outline.connects_to
+        connections_info = ", ".join(connections) if connections else "None specified"
+        
+        # Calculate desired dialogue count (6-10 lines by default)
+        dialogue_count = scene_outline.dialogue_count or _stable_dialogue_count(scene_id, 6, 10)
+        
+        # Create a prompt for generating this specific scene
+        prompt = _SCENE_PROMPT_TEMPLATE.format(
+            scene_id=scene_id,
+            description=scene_outline.description,
+            setting=scene_outline.setting,
+            atmosphere=scene_outline.atmosphere,
+            character_info=character_info,
+            connections_info=connections_info,
+            dialogue_count=dialogue_count
+        )
+        
+        # Generate and parse the scene
+        scene_data = await _create_completion(
+            client,
             model="gpt-4-turbo",  # Using the most capable model for creative content
             response_format={"type": "json_object"},
             messages=[
-                {"role": "system", "content": "You are a master writer of interactive fiction, specializing in creating immersive, literary-quality scenes with authentic dialogue."},
+                {"role": "system", "content": _SCENE_SYSTEM_PROMPT},
                 {"role": "user", "content": prompt}
             ],
             temperature=0.8,  # Higher temperature for more creative, varied output
-            max_tokens=3500,  # Increased limit for richer content
-            timeout=90  # Extended timeout
+            max_tokens=SCENE_MAX_OUTPUT_TOKENS,  # Increased limit for richer content
+            timeout=SCENE_TIMEOUT,
+            parse=_parse_scene
         )
+        logger.debug("Successfully generated scene %s with %s dialogue lines", scene_id, len(scene_data.get('dialogue', [])))
         
-        # Parse the response
-        scene_text = response.choices[0].message.content
+        # Save to cache
+        _cache_scene(scene_id, scene_outline, scene_data, reuse_identical)
+        
+        return scene_data
         
-        try:
-            scene_data = json.loads(scene_text)
-            print(f"Successfully generated scene {scene_id} with {len(scene_data.get('dialogue', []))} dialogue lines")
-            
-            # Save to cache
-            STORY_CACHE["generated_scenes"][scene_id] = scene_data
-            
-            # Remove from in-progress set
-            STORY_CACHE["in_progress_scenes"].remove(scene_id)
-            
-            return scene_data
-            
-        except json.JSONDecodeError as e:
-            print(f"Error parsing scene JSON: {e}")
-            
-            # Try to fix the JSON
-            try:
-                fixed_text = attempt_json_repair(scene_text)
-                if fixed_text != scene_text:
-                    scene_data = json.loads(fixed_text)
-                    print(f"Fixed JSON for scene {scene_id}")
-                    
-                    # Save to cache
-                    STORY_CACHE["generated_scenes"][scene_id] = scene_data
-                    
-                    # Remove from in-progress set
-                    STORY_CACHE["in_progress_scenes"].remove(scene_id)
-                    
-                    return scene_data
-            except:
-                print(f"Failed to fix JSON for scene {scene_id}")
-            
-            # Create a placeholder scene as fallback
-            placeholder_scene = create_placeholder_scene(scene_id, scene_outline, book_analysis)
-            
-            # Save to cache
-            STORY_CACHE["generated_scenes"][scene_id] = placeholder_scene
-            
-            # Remove from in-progress set
-            STORY_CACHE["in_progress_scenes"].remove(scene_id)
-            
-            return placeholder_scene
-            
     except Exception as e:
-        print(f"Error generating scene {scene_id}: {str(e)}")
+        logger.error("Error generating scene %s: %s", scene_id, e)
         
         # Create a placeholder scene
         placeholder_scene = create_placeholder_scene(scene_id, scene_outline, book_analysis)
@@ -469,19 +1084,16 @@ async def generate_scene_from_outline(scene_outline, book_analysis, client):
         # Save to cache
         STORY_CACHE["generated_scenes"][scene_id] = placeholder_scene
         
-        # Remove from in-progress set
-        if scene_id in STORY_CACHE["in_progress_scenes"]:
-            STORY_CACHE["in_progress_scenes"].remove(scene_id)
-        
         return placeholder_scene
 
 def create_placeholder_scene(scene_id, scene_outline, book_analysis):
     """Create a placeholder scene when generation fails"""
     # Find characters for this scene
     characters = []
-    for char_id in scene_outline.get("characters", []):
+    char_index = _get_character_index(book_analysis)
+    for char_id in scene_outline.characters:
         # Look up in book analysis
-        char = next((c for c in book_analysis.get("characters", []) if c.get("id") == char_id or c.get("name").lower() == char_id.lower()), None)
+        char = char_index.get(char_id.lower())
         if char:
             characters.append({
                 "id": char.get("id", char_id),
@@ -494,11 +1106,12 @@ def create_placeholder_scene(scene_id, scene_outline, book_analysis):
             "id": "character",
             "image": "A person relevant to this scene"
         })
+    lead_id = characters[0]["id"]
     
     # Create dialogue based on the scene description
-    description = scene_outline.get("description", "A scene in the story")
-    setting = scene_outline.get("setting", "An important location")
-    atmosphere = scene_outline.get("atmosphere", "Creates a specific mood")
+    description = scene_outline.description
+    setting = scene_outline.setting
+    atmosphere = scene_outline.atmosphere
     
     # Create dialogue array
     dialogue = [
@@ -512,17 +1125,15 @@ def create_placeholder_scene(scene_id, scene_outline, book_analysis):
         }
     ]
     
-    # Add character dialogue if characters exist
-    if characters:
-        char = characters[0]
-        dialogue.append({
-            "speaker": char.get("id", "Character"),
-            "text": "We need to proceed carefully in this situation.",
-            "character": char.get("id")
-        })
+    # Add character dialogue; there is always at least the generic character
+    dialogue.append({
+        "speaker": lead_id,
+        "text": "We need to proceed carefully in this situation.",
+        "character": lead_id
+    })
     
     # Add choices based on connections
-    connections = scene_outline.get("connects_to", [])
+    connections = scene_outline.connects_to
     choices = []
     
     for conn in connections:
@@ -557,38 +1168,43 @@ def create_placeholder_scene(scene_id, scene_outline, book_analysis):
 
 async def enhance_visual_novel(script_data, characters):
     """Add visual elements to the script using AI-generated images"""
-    print("Enhancing visual novel with AI-generated images...")
+    logger.info("Enhancing visual novel with AI-generated images...")
     
     # Check if Replicate API token is available
     replicate_api_token = os.environ.get("REPLICATE_API_TOKEN")
     use_ai_images = replicate_api_token is not None
     
     if use_ai_images:
-        print("Using Replicate for AI image generation")
+        logger.info("Using Replicate for AI image generation")
     else:
-        print("REPLICATE_API_TOKEN not found, using SVG placeholders instead")
-    
-    # Generate backgrounds for different settings if needed
-    await generate_backgrounds(script_data, use_ai_images)
+        logger.info("REPLICATE_API_TOKEN not found, using SVG placeholders instead")
     
-    # Generate character images
-    await generate_character_images(script_data, characters, use_ai_images)
+    # Backgrounds and character images are independent, so generate them together
+    await asyncio.gather(
+        generate_backgrounds(script_data, use_ai_images),
+        generate_character_images(script_data, characters, use_ai_images)
+    )
     
-    print("Visual enhancement complete")
+    logger.info("Visual enhancement complete")
     return script_data
 
+_BACKGROUND_WORD_RE = re.compile(r"[a-z0-9]+")
+_BACKGROUND_STOPWORDS = frozenset([
+    "a", "an", "the", "and", "or", "of", "in", "on", "at", "to", "by", "for",
+    "with", "from", "into", "onto", "is", "are", "its", "that", "this", "which"
+])
+
+def _background_cluster_key(background_desc):
+    """
+    Normalize a background description so descriptions differing only in
+    case, punctuation, word order or stopwords share a key
+    """
+    words = set(_BACKGROUND_WORD_RE.findall(background_desc.lower())) - _BACKGROUND_STOPWORDS
+    return " ".join(sorted(words)) or background_desc
+
 async def generate_backgrounds(script_data, use_ai_images):
     """Generate background images for scenes"""
-    # Default SVG backgrounds for fallback
-    default_backgrounds = {
-        "main": "data:image/svg+xml;utf8,<svg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 800 600'><rect width='800' height='600' fill='%23243b55'/><path d='M0 450 Q 400 400 800 450 L 800 600 L 0 600 Z' fill='%23141e30'/></svg>",
-        "secondary": "data:image/svg+xml;utf8,<svg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 800 600'><rect width='800' height='600' fill='%232c3e50'/><path d='M0 450 Q 400 400 800 450 L 800 600 L 0 600 Z' fill='%23141e30'/></svg>",
-        "dark": "data:image/svg+xml;utf8,<svg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 800 600'><rect width='800' height='600' fill='%231a1a2e'/><path d='M0 450 Q 400 400 800 450 L 800 600 L 0 600 Z' fill='%230f0f1a'/></svg>",
-        "light": "data:image/svg+xml;utf8,<svg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 800 600'><rect width='800' height='600' fill='%23e0e0e0'/><path d='M0 450 Q 400 400 800 450 L 800 600 L 0 600 Z' fill='%23c0c0c0'/></svg>",
-        "forest": "data:image/svg+xml;utf8,<svg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 800 600'><rect width='800' height='600' fill='%23234010'/><path d='M0 450 Q 400 400 800 450 L 800 600 L 0 600 Z' fill='%23132010'/></svg>"
-    }
-    
-    scene_types = list(default_backgrounds.keys())
+    bg_cache = IMAGE_CACHE["backgrounds"]
     unique_backgrounds = set()
     
     # First pass: collect all unique background descriptions
@@ -600,33 +1216,30 @@ async def generate_backgrounds(script_data, use_ai_images):
     
     # Generate AI backgrounds for unique descriptions
     if use_ai_images and unique_backgrounds:
-        print(f"Generating {len(unique_backgrounds)} unique AI backgrounds")
+        logger.info("Generating %s unique AI backgrounds", len(unique_backgrounds))
         
-        for background_desc in unique_backgrounds:
-            # Skip if already in cache
-            if background_desc in IMAGE_CACHE["backgrounds"]:
-                continue
-                
-            # Skip if it's an empty or very short description
-            if len(background_desc) < 10:
-                continue
-            
+        async def _generate_background(background_descs):
+            # One image serves every description in the group; the groups
+            # are sorted, so the prompt doesn't depend on set order
+            background_desc = background_descs[0]
             try:
                 # Generate an AI image for this background
                 prompt = f"A detailed atmospheric scene: {background_desc}. Suitable as a visual novel background, high quality, detailed."
-                
-                # Try to get from cache first
-                if background_desc in IMAGE_CACHE["backgrounds"]:
-                    print(f"Using cached background for: {background_desc[:30]}...")
-                else:
-                    print(f"Generating background for: {background_desc[:30]}...")
-                    image_url = await generate_image_with_replicate(prompt)
-                    if image_url:
-                        # Convert to data URI for embedding
-                        data_uri = await url_to_data_uri(image_url)
-                        IMAGE_CACHE["backgrounds"][background_desc] = data_uri
+                logger.debug("Generating background for: %s...", background_desc[:30])
+                data_uri = await generate_image_data_uri(prompt)
+                if data_uri:
+                    for desc in background_descs:
+                        bg_cache[desc] = data_uri
             except Exception as e:
-                print(f"Error generating background image: {str(e)}")
+                logger.error("Error generating background image: %s", e)
+        
+        # Skip cached and empty or very short descriptions, and group
+        # near-duplicates so each group is generated once
+        clusters = {}
+        for background_desc in unique_backgrounds:
+            if background_desc not in bg_cache and len(background_desc) >= 10:
+                clusters.setdefault(_background_cluster_key(background_desc), []).append(background_desc)
+        await asyncio.gather(*(_generate_background(sorted(background_descs)) for background_descs in clusters.values()))
     
     # Second pass: assign backgrounds to scenes
     for i, scene in enumerate(script_data["scenes"]):
@@ -637,17 +1250,17 @@ async def generate_backgrounds(script_data, use_ai_images):
             continue
             
         # Use AI-generated background if available
-        if use_ai_images and background_desc in IMAGE_CACHE["backgrounds"]:
-            scene["background"] = IMAGE_CACHE["backgrounds"][background_desc]
+        data_uri = bg_cache.get(background_desc) if use_ai_images else None
+        if data_uri:
+            scene["background"] = data_uri
         else:
             # Fall back to SVG placeholder
-            scene_type = scene_types[i % len(scene_types)]
-            scene["background"] = default_backgrounds[scene_type]
+            scene_type = _SCENE_TYPES[i % len(_SCENE_TYPES)]
+            scene["background"] = _DEFAULT_BACKGROUNDS[scene_type]
 
 async def generate_character_images(script_data, characters, use_ai_images):
     """Generate character images based on descriptions"""
-    # Default SVG character template
-    colors = ["f9d5e5", "b06ab3", "6a0572", "d1d1e0", "800000", "333333", "e6ccb2", "7b7554", "c0d6df", "4a6fa5"]
+    char_cache = IMAGE_CACHE["characters"]
     
     # Create a map of character IDs to descriptions
     character_descriptions = {}
@@ -667,32 +1280,28 @@ async def generate_character_images(script_data, characters, use_ai_images):
     
     # Generate AI character images
     if use_ai_images:
-        print(f"Generating {len(unique_characters)} unique AI character images")
+        logger.info("Generating %s unique AI character images", len(unique_characters))
         
-        for char_id in unique_characters:
-            # Skip if already in cache
-            if char_id in IMAGE_CACHE["characters"]:
-                continue
-            
+        async def _generate_character(char_id):
             # Get description from the character info
             description = character_descriptions.get(char_id, f"Character {char_id}")
             
             try:
-                # Try to get from cache first
-                if char_id in IMAGE_CACHE["characters"]:
-                    print(f"Using cached character image for {char_id}")
-                else:
-                    print(f"Generating character image for {char_id}: {description[:30]}...")
-                    # Enhance prompt for better character images
-                    prompt = f"Portrait of {description}. Full-body portrait, high-quality, detailed, visual novel style, well-lit, clear features, expressive pose."
-                    
-                    image_url = await generate_image_with_replicate(prompt)
-                    if image_url:
-                        # Convert to data URI for embedding
-                        data_uri = await url_to_data_uri(image_url)
-                        IMAGE_CACHE["characters"][char_id] = data_uri
+                logger.debug("Generating character image for %s: %s...", char_id, description[:30])
+                # Enhance prompt for better character images
+                prompt = f"Portrait of {description}. Full-body portrait, high-quality, detailed, visual novel style, well-lit, clear features, expressive pose."
+                
+                data_uri = await generate_image_data_uri(prompt)
+                if data_uri:
+                    char_cache[char_id] = data_uri
             except Exception as e:
-                print(f"Error generating character image: {str(e)}")
+                logger.error("Error generating character image: %s", e)
+        
+        # Skip characters already in cache
+        await asyncio.gather(*(
+            _generate_character(char_id) for char_id in unique_characters
+            if char_id not in char_cache
+        ))
     
     # Now update all character references in all scenes
     for scene in script_data["scenes"]:
@@ -700,18 +1309,44 @@ async def generate_character_images(script_data, characters, use_ai_images):
             char_id = char.get("id", "")
             
             # If we have an AI-generated image, use it
-            if use_ai_images and char_id in IMAGE_CACHE["characters"]:
-                char["image"] = IMAGE_CACHE["characters"][char_id]
+            data_uri = char_cache.get(char_id) if use_ai_images else None
+            if data_uri:
+                char["image"] = data_uri
             else:
-                # Fall back to SVG placeholder
-                color_idx = hash(char_id) % len(colors)
-                char["image"] = f"data:image/svg+xml;utf8,<svg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 100 250'><rect x='35' y='20' width='30' height='30' rx='15' fill='%23{colors[color_idx]}'/><rect x='30' y='50' width='40' height='60' fill='%23{colors[(color_idx+1) % len(colors)]}'/><rect x='25' y='110' width='50' height='50' fill='%23{colors[(color_idx+2) % len(colors)]}'/><rect x='25' y='110' width='20' height='70' rx='5' fill='%23{colors[(color_idx+2) % len(colors)]}'/><rect x='55' y='110' width='20' height='70' rx='5' fill='%23{colors[(color_idx+2) % len(colors)]}'/></svg>"
+                # Fall back to SVG placeholder, colored by a hash that is stable across processes
+                char["image"] = _placeholder_character_svg(zlib.crc32(char_id.encode()))
+
+# Upper bound on concurrent image generations and downloads
+_IMAGE_SEM = asyncio.Semaphore(int(os.environ.get("IMAGE_CONCURRENCY", "4")))
+
+async def generate_image_data_uri(prompt):
+    """Generate an image for the prompt and return it as a data URI, or None"""
+    async with _IMAGE_SEM:
+        image_url = await generate_image_with_replicate(prompt)
+        if not image_url:
+            return None
+        # Convert to data URI for embedding
+        return await url_to_data_uri(image_url)
+
+# Shared Replicate client, created on first use. replicate.Client has no
+# close method, so we own its HTTP transport and close that on shutdown
+_REPLICATE_STATE = {"client": None, "transport": None}
+
+def _get_replicate_client():
+    import httpx
+    import replicate
+    
+    if _REPLICATE_STATE["client"] is None:
+        transport = httpx.AsyncHTTPTransport()
+        _REPLICATE_STATE["transport"] = transport
+        _REPLICATE_STATE["client"] = replicate.Client(api_token=os.environ.get("REPLICATE_API_TOKEN"), transport=transport)
+    return _REPLICATE_STATE["client"]
 
 async def generate_image_with_replicate(prompt):
     """Generate an image using Replicate API"""
     try:
         # Run the SDXL Lightning model with the provided prompt
-        output = replicate.run(
+        output = await _get_replicate_client().async_run(
             "bytedance/sdxl-lightning-4step:5599ed30703defd1d160a25a63321b4dec97101d98b4674bcc56e41f62f35637",
             input={
                 "width": 1024,
@@ -731,48 +1366,111 @@ async def generate_image_with_replicate(prompt):
         
         return None
     except Exception as e:
-        print(f"Error generating image with Replicate: {str(e)}")
+        logger.error("Error generating image with Replicate: %s", e)
         return None
 
+# Shared HTTP session for image downloads, created on first use so its
+# pooled keep-alive connections are reused across images
+_HTTP_STATE = {"session": None}
+
+def _get_http_session():
+    import aiohttp
+    
+    session = _HTTP_STATE["session"]
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=32, limit_per_host=16, ttl_dns_cache=300)
+        session = aiohttp.ClientSession(connector=connector)
+        _HTTP_STATE["session"] = session
+    return session
+
+async def close_http_clients():
+    """
+    Close the shared image HTTP clients and shut down the image encoding
+    pool, if any; call on application shutdown
+    """
+    session = _HTTP_STATE["session"]
+    _HTTP_STATE["session"] = None
+    if session is not None and not session.closed:
+        await session.close()
+    transport = _REPLICATE_STATE["transport"]
+    _REPLICATE_STATE["client"] = None
+    _REPLICATE_STATE["transport"] = None
+    if transport is not None:
+        await transport.aclose()
+    
+    executor = _ENCODE_POOL["executor"]
+    _ENCODE_POOL["executor"] = None
+    if executor is not None:
+        # Joining the worker processes blocks, so do it off the event loop
+        await asyncio.to_thread(executor.shutdown)
+
+# Pillow releases the GIL while decoding and encoding, so threads are usually
+# enough; set IMAGE_ENCODE_PROCESSES to encode across processes instead
+IMAGE_ENCODE_PROCESSES = int(os.environ.get("IMAGE_ENCODE_PROCESSES", "0"))
+_ENCODE_POOL = {"executor": None}
+
+def _encode_to_data_uri(image_bytes: bytes) -> str:
+    """Resize an image and re-encode it as a WebP data URI"""
+    import base64
+    from io import BytesIO
+    from PIL import Image
+    
+    image = Image.open(BytesIO(image_bytes))
+    
+    # Resize for reasonable file size
+    max_size = (800, 800)
+    image.thumbnail(max_size)
+    
+    # Convert to WebP, noticeably smaller than JPEG at similar quality
+    buffer = BytesIO()
+    image.save(buffer, format="WEBP", quality=80, method=4)
+    base64_image = base64.b64encode(buffer.getvalue()).decode('utf-8')
+    
+    # Create the data URI
+    return f"data:image/webp;base64,{base64_image}"
+
+async def _encode_off_loop(image_bytes):
+    """Run _encode_to_data_uri in a worker thread or process"""
+    if IMAGE_ENCODE_PROCESSES <= 0:
+        return await asyncio.to_thread(_encode_to_data_uri, image_bytes)
+    
+    if _ENCODE_POOL["executor"] is None:
+        from concurrent.futures import ProcessPoolExecutor
+        _ENCODE_POOL["executor"] = ProcessPoolExecutor(max_workers=IMAGE_ENCODE_PROCESSES)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_ENCODE_POOL["executor"], _encode_to_data_uri, image_bytes)
+
 async def url_to_data_uri(url):
     """Convert an image URL to a data URI for embedding in HTML"""
     try:
-        response = requests.get(url)
-        if response.status_code == 200:
-            # Get the image and convert it to base64
-            image_content = response.content
-            image = Image.open(BytesIO(image_content))
-            
-            # Resize for reasonable file size
-            max_size = (800, 800)
-            image.thumbnail(max_size)
-            
-            # Convert to JPEG with reasonable quality
-            buffer = BytesIO()
-            image.save(buffer, format="JPEG", quality=85)
-            base64_image = base64.b64encode(buffer.getvalue()).decode('utf-8')
-            
-            # Create the data URI
-            return f"data:image/jpeg;base64,{base64_image}"
-        else:
-            print(f"Failed to download image: {response.status_code}")
-            return None
+        # replicate 1.x returns FileOutput objects rather than strings, and
+        # aiohttp only accepts str or URL
+        async with _get_http_session().get(str(url)) as response:
+            if response.status != 200:
+                logger.warning("Failed to download image: %s", response.status)
+                return None
+            image_content = await response.read()
+        
+        # Decoding and resizing is CPU-bound, so keep it off the event loop
+        return await _encode_off_loop(image_content)
     except Exception as e:
-        print(f"Error converting image to data URI: {str(e)}")
+        logger.error("Error converting image to data URI: %s", e)
         return None
-        
+
 def validate_and_fix_scene_connections(script_data):
     """
     Validate and fix scene connections to ensure all nextScene references
     point to valid scenes and all scenes are reachable
     """
-    print("Validating scene connections...")
+    logger.info("Validating scene connections...")
     
-    # Get all scene IDs
-    scene_ids = set(scene["id"] for scene in script_data["scenes"])
-    print(f"Found {len(scene_ids)} scenes: {', '.join(scene_ids)}")
+    # Index scenes by ID
+    scene_by_id = {scene["id"]: scene for scene in script_data["scenes"]}
+    scene_ids = set(scene_by_id)
+    logger.debug("Found %s scenes: %s", len(scene_ids), ', '.join(scene_ids))
     
-    # Find all nextScene references in choices
+    # Find all nextScene references in choices, keeping the choice itself so
+    # invalid references can be fixed in place
     next_scene_refs = []
     
     for scene in script_data["scenes"]:
@@ -782,102 +1480,188 @@ def validate_and_fix_scene_connections(script_data):
                     if "nextScene" in choice:
                         next_scene_refs.append({
                             "source_scene": scene["id"],
-                            "choice_text": choice["text"],
+                            "choice": choice,
                             "next_scene": choice["nextScene"]
                         })
     
-    print(f"Found {len(next_scene_refs)} nextScene references")
+    logger.debug("Found %s nextScene references", len(next_scene_refs))
     
     # Check for invalid references
     invalid_refs = [ref for ref in next_scene_refs if ref["next_scene"] not in scene_ids and ref["next_scene"] != "exit"]
-    print(f"Found {len(invalid_refs)} invalid nextScene references")
+    logger.info("Found %s invalid nextScene references", len(invalid_refs))
     
     # Fix invalid references
+    fallback_scene_id = next(iter(scene_ids)) if scene_ids else None
     for ref in invalid_refs:
-        print(f"Invalid reference from {ref['source_scene']} -> {ref['next_scene']} in choice '{ref['choice_text']}'")
+        logger.debug("Invalid reference from %s -> %s in choice '%s'", ref['source_scene'], ref['next_scene'], ref['choice'].get('text'))
         
         # Try to find a similar scene ID
         similar_ids = [sid for sid in scene_ids if ref["next_scene"] in sid or sid in ref["next_scene"]]
         
-        # Update the reference in the script
-        for scene in script_data["scenes"]:
-            if scene["id"] == ref["source_scene"]:
-                for dialogue in scene["dialogue"]:
-                    if "choices" in dialogue:
-                        for choice in dialogue["choices"]:
-                            if choice.get("text") == ref["choice_text"] and choice.get("nextScene") == ref["next_scene"]:
-                                if similar_ids:
-                                    choice["nextScene"] = similar_ids[0]
-                                    print(f"  Fixed by changing to {similar_ids[0]}")
-                                else:
-                                    # Default to the first scene as fallback
-                                    choice["nextScene"] = list(scene_ids)[0]
-                                    print(f"  Fixed by changing to {list(scene_ids)[0]} (fallback)")
-    
-    # Check for unreachable scenes
-    reachable = set(["scene_intro", "scene_1"])  # Assuming scene_intro or scene_1 is the starting point
-    
-    # If neither scene_intro nor scene_1 exists, use the first scene
-    if not any(id in scene_ids for id in reachable):
-        reachable = set([next(iter(scene_ids))])
-    
-    # Keep expanding the set of reachable scenes until no new scenes are added
-    old_size = 0
-    while len(reachable) > old_size:
-        old_size = len(reachable)
-        
-        for ref in next_scene_refs:
-            if ref["source_scene"] in reachable and ref["next_scene"] != "exit":
-                reachable.add(ref["next_scene"])
+        if similar_ids:
+            ref["choice"]["nextScene"] = similar_ids[0]
+            logger.debug("  Fixed by changing to %s", similar_ids[0])
+        else:
+            # Default to the first scene as fallback
+            ref["choice"]["nextScene"] = fallback_scene_id
+            logger.debug("  Fixed by changing to %s (fallback)", fallback_scene_id)
+    
+    # Build the (fixed) scene adjacency once
+    edges = {}
+    for ref in next_scene_refs:
+        edges.setdefault(ref["source_scene"], []).append(ref["choice"]["nextScene"])
+    
+    # Check for unreachable scenes, assuming scene_intro or scene_1 is the
+    # starting point; if neither exists, use the first scene
+    reachable = set(sid for sid in ("scene_intro", "scene_1") if sid in scene_ids) or set([fallback_scene_id])
+    
+    # Breadth-first search from the starting scenes
+    queue = deque(reachable)
+    while queue:
+        for next_scene in edges.get(queue.popleft(), ()):
+            if next_scene != "exit" and next_scene not in reachable:
+                reachable.add(next_scene)
+                queue.append(next_scene)
     
     unreachable = scene_ids - reachable
     
     if unreachable:
-        print(f"Warning: Found {len(unreachable)} unreachable scenes: {', '.join(unreachable)}")
-        # Add connections to unreachable scenes
+        logger.warning("Found %s unreachable scenes: %s", len(unreachable), ', '.join(unreachable))
+        # Add connections to unreachable scenes, from scenes that actually exist
+        sources = [sid for sid in reachable if sid in scene_by_id]
         for scene_id in unreachable:
             # Add a way to reach this scene from a random reachable scene
-            source_scene_id = random.choice(list(reachable))
-            print(f"  Adding connection from {source_scene_id} to unreachable scene {scene_id}")
+            source_scene_id = random.choice(sources)
+            logger.debug("  Adding connection from %s to unreachable scene %s", source_scene_id, scene_id)
             
-            # Find the source scene
-            for scene in script_data["scenes"]:
-                if scene["id"] == source_scene_id:
-                    # Add a new choice to the last dialogue if it has choices
-                    for dialogue in reversed(scene["dialogue"]):
-                        if "choices" in dialogue:
-                            dialogue["choices"].append({
-                                "text": f"Explore a different path",
-                                "nextScene": scene_id
-                            })
-                            break
+            # Add a new choice to the last dialogue if it has choices
+            source_scene = scene_by_id.get(source_scene_id)
+            if source_scene:
+                for dialogue in reversed(source_scene["dialogue"]):
+                    if "choices" in dialogue:
+                        dialogue["choices"].append({
+                            "text": f"Explore a different path",
+                            "nextScene": scene_id
+                        })
+                        break
     
     return script_data
 
 # Helper function to attempt to repair broken JSON
 def attempt_json_repair(json_text):
     """Attempt to fix common JSON errors"""
-    # Try to fix unclosed quotes
-    json_text = re.sub(r'([^\\])"([^"]*)$', r'\1"\2"', json_text)
-    
-    # Try to fix missing closing braces
-    open_braces = json_text.count('{')
-    close_braces = json_text.count('}')
-    if open_braces > close_braces:
-        json_text += '}' * (open_braces - close_braces)
+    json_text = extract_json_span(json_text)
+    if repair_json is not None:
+        return repair_json(json_text)
     
-    # Try to fix missing closing brackets
-    open_brackets = json_text.count('[')
-    close_brackets = json_text.count(']')
-    if open_brackets > close_brackets:
-        json_text += ']' * (open_brackets - close_brackets)
+    # Stripping the fence or surrounding prose may have been enough
+    try:
+        json_loads(json_text)
+        return json_text
+    except ValueError:
+        pass
     
-    return json_text
+    # Otherwise close whatever a truncated response left open
+    return close_json_brackets(json_text)
+
+def _narrate(text, choices=None):
+    """Build a narrator dialogue line, optionally ending in choices"""
+    line = {"speaker": "Narrator", "text": text}
+    if choices:
+        line["choices"] = choices
+    return line
+
+def _char_line(speaker, text, character_id, choices=None):
+    """Build a character dialogue line, optionally ending in choices"""
+    line = {"speaker": speaker, "text": text, "character": character_id}
+    if choices:
+        line["choices"] = choices
+    return line
+
+# Cast used when the analysis found no characters; only ever read
+_DEFAULT_CHARACTERS = (
+    {"id": "protagonist", "name": "Protagonist", "description": "The main character"},
+    {"id": "supporting", "name": "Supporting Character", "description": "A helpful friend"},
+    {"id": "antagonist", "name": "Antagonist", "description": "The opposition"}
+)
+
+# Scenes following the intro choice where the protagonist speaks:
+# (scene ID, background, opening line, narration, question, choices)
+_PLACEHOLDER_PATH_SCENES = (
+    ("scene_2", _DEFAULT_BACKGROUNDS["main"],
+     "I need to face this challenge head-on.",
+     "With determination guiding your steps, you move forward.",
+     "What path should I take?",
+     (("The direct approach", "scene_5"), ("Seek allies first", "scene_6"), ("Gather more information", "scene_7"))),
+    ("scene_3", _DEFAULT_BACKGROUNDS["secondary"],
+     "I need to plan carefully before proceeding.",
+     "Taking your time to consider options might reveal hidden paths.",
+     "What should I focus on first?",
+     (("Study the situation", "scene_8"), ("Prepare equipment", "scene_9"), ("Consult with others", "scene_10"))),
+)
+
+# The fate scene has no per-book content: (scene ID, background, dialogue)
+_FATE_SCENE = (
+    "scene_4",
+    _DEFAULT_BACKGROUNDS["dark"],
+    (
+        {"speaker": "Narrator", "text": "You surrender to the flow of the story, letting fate guide your journey."},
+        {"speaker": "Narrator", "text": "Sometimes the most interesting paths are those we don't choose ourselves."},
+        {
+            "speaker": "Narrator",
+            "text": "As you drift with the current of the narrative, you find yourself drawn to...",
+            "choices": (
+                {"text": "A mysterious encounter", "nextScene": "scene_7"},
+                {"text": "An unexpected opportunity", "nextScene": "scene_8"},
+                {"text": "A moment of revelation", "nextScene": "scene_9"}
+            )
+        }
+    )
+)
+
+# Filler scenes for the remaining paths: (scene ID, background)
+_BASIC_SCENES = (
+    ("scene_5", _DEFAULT_BACKGROUNDS["main"]),
+    ("scene_6", _DEFAULT_BACKGROUNDS["secondary"]),
+    ("scene_7", _DEFAULT_BACKGROUNDS["dark"]),
+    ("scene_8", _DEFAULT_BACKGROUNDS["secondary"]),
+    ("scene_9", _DEFAULT_BACKGROUNDS["main"]),
+    ("scene_10", _DEFAULT_BACKGROUNDS["dark"])
+)
+
+# Dialogue shared by the filler scenes of the placeholder script
+_BASIC_SCENE_DIALOGUE = (
+    {
+        "speaker": "Narrator",
+        "text": "Your journey continues along this path..."
+    },
+    {
+        "speaker": "Narrator",
+        "text": "What would you like to do next?",
+        "choices": (
+            {"text": "Return to the beginning", "nextScene": "scene_1"},
+            {"text": "Continue on this path", "nextScene": "scene_1"}
+        )
+    }
+)
+
+def _copy_dialogue(template):
+    """
+    Copy a dialogue template into fresh lines. Choices are copied too, since
+    validate_and_fix_scene_connections edits and appends to them in place.
+    """
+    dialogue = []
+    for line in template:
+        line = line.copy()
+        if "choices" in line:
+            line["choices"] = [choice.copy() for choice in line["choices"]]
+        dialogue.append(line)
+    return dialogue
 
 # Placeholder script generator for when AI fails
 async def generate_placeholder_script(book_analysis: dict) -> dict:
     """Fallback script generator"""
-    print("Using placeholder script generator as fallback")
+    logger.warning("Using placeholder script generator as fallback")
     
     # Create placeholder for visual novel script
     title = book_analysis["metadata"].get("title", "Adventure")
@@ -886,211 +1670,86 @@ async def generate_placeholder_script(book_analysis: dict) -> dict:
         "scenes": []
     }
     
-    # Generate SVG backgrounds for different settings
-    backgrounds = {
-        "main": "data:image/svg+xml;utf8,<svg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 800 600'><rect width='800' height='600' fill='%23243b55'/><path d='M0 450 Q 400 400 800 450 L 800 600 L 0 600 Z' fill='%23141e30'/></svg>",
-        "secondary": "data:image/svg+xml;utf8,<svg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 800 600'><rect width='800' height='600' fill='%232c3e50'/><path d='M0 450 Q 400 400 800 450 L 800 600 L 0 600 Z' fill='%23141e30'/></svg>",
-        "dark": "data:image/svg+xml;utf8,<svg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 800 600'><rect width='800' height='600' fill='%231a1a2e'/><path d='M0 450 Q 400 400 800 450 L 800 600 L 0 600 Z' fill='%230f0f1a'/></svg>"
-    }
+    characters = book_analysis.get("characters") or _DEFAULT_CHARACTERS
     
-    # Generate SVG character images for each character
+    # Generate SVG character images and collect names in one pass; every
+    # id used below comes from this list, so lookups need no fallback
     character_images = {}
-    colors = ["f9d5e5", "b06ab3", "6a0572", "d1d1e0", "800000", "333333", "e6ccb2", "7b7554", "c0d6df", "4a6fa5"]
-    
-    characters = book_analysis.get("characters", [])
-    if not characters:
-        characters = [
-            {"id": "protagonist", "name": "Protagonist", "description": "The main character"},
-            {"id": "supporting", "name": "Supporting Character", "description": "A helpful friend"},
-            {"id": "antagonist", "name": "Antagonist", "description": "The opposition"}
-        ]
-    
+    character_names = {}
     for i, character in enumerate(characters):
-        color_idx = i % len(colors)
-        character_images[character["id"]] = f"data:image/svg+xml;utf8,<svg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 100 250'><rect x='35' y='20' width='30' height='30' rx='15' fill='%23{colors[color_idx]}'/><rect x='30' y='50' width='40' height='60' fill='%23{colors[(color_idx+1) % len(colors)]}'/><rect x='25' y='110' width='50' height='50' fill='%23{colors[(color_idx+2) % len(colors)]}'/><rect x='25' y='110' width='20' height='70' rx='5' fill='%23{colors[(color_idx+2) % len(colors)]}'/><rect x='55' y='110' width='20' height='70' rx='5' fill='%23{colors[(color_idx+2) % len(colors)]}'/></svg>"
+        character_images[character["id"]] = _placeholder_character_svg(i)
+        character_names[character["id"]] = character["name"]
     
-    # Get character names
-    character_names = {char["id"]: char["name"] for char in characters}
-    
-    # Create intro scene
-    intro_scene = {
+    # Create intro scene: welcome, summary, character introductions (limited
+    # to the first 2 characters to keep it simple) and the opening choice
+    vn_script["scenes"].append({
         "id": "scene_1",
-        "background": backgrounds["main"],
+        "background": _DEFAULT_BACKGROUNDS["main"],
         "characters": [],
         "dialogue": [
-            {
-                "speaker": "Narrator",
-                "text": f"Welcome to the world of {title}."
-            },
-            {
-                "speaker": "Narrator",
-                "text": book_analysis.get("plot", {}).get("summary", "An exciting adventure awaits!")
-            }
-        ]
-    }
-    
-    # Add character introductions
-    for character in characters[:2]:  # Limit to first 2 characters to keep it simple
-        intro_scene["dialogue"].append({
-            "speaker": "Narrator",
-            "text": f"Meet {character['name']}, {character['description']}."
-        })
-    
-    # Add choice to the intro
-    intro_scene["dialogue"].append({
-        "speaker": "Narrator",
-        "text": "How would you like to begin this adventure?",
-        "choices": [
-            {"text": "With courage and determination", "nextScene": "scene_2"},
-            {"text": "With caution and planning", "nextScene": "scene_3"},
-            {"text": "Let fate decide my path", "nextScene": "scene_4"}
+            _narrate(f"Welcome to the world of {title}."),
+            _narrate(book_analysis.get("plot", {}).get("summary", "An exciting adventure awaits!")),
+            *(_narrate(f"Meet {character['name']}, {character['description']}.") for character in characters[:2]),
+            _narrate("How would you like to begin this adventure?", [
+                {"text": "With courage and determination", "nextScene": "scene_2"},
+                {"text": "With caution and planning", "nextScene": "scene_3"},
+                {"text": "Let fate decide my path", "nextScene": "scene_4"}
+            ])
         ]
     })
     
-    vn_script["scenes"].append(intro_scene)
-    
-    # Create main character path
-    main_char = characters[0] if characters else {"id": "protagonist", "name": "Protagonist"}
-    
-    main_scene = {
-        "id": "scene_2",
-        "background": backgrounds["main"],
-        "characters": [
-            {"id": main_char["id"], "image": character_images[main_char["id"]]}
-        ],
-        "dialogue": [
-            {
-                "speaker": character_names.get(main_char["id"], "Protagonist"),
-                "text": "I need to face this challenge head-on.",
-                "character": main_char["id"]
-            },
-            {
-                "speaker": "Narrator",
-                "text": "With determination guiding your steps, you move forward."
-            },
-            {
-                "speaker": character_names.get(main_char["id"], "Protagonist"),
-                "text": "What path should I take?",
-                "character": main_char["id"],
-                "choices": [
-                    {"text": "The direct approach", "nextScene": "scene_5"},
-                    {"text": "Seek allies first", "nextScene": "scene_6"},
-                    {"text": "Gather more information", "nextScene": "scene_7"}
-                ]
-            }
-        ]
-    }
-    
-    vn_script["scenes"].append(main_scene)
-    
-    # Add a few more scenes to ensure there's enough content
-    planning_scene = {
-        "id": "scene_3",
-        "background": backgrounds["secondary"],
-        "characters": [
-            {"id": main_char["id"], "image": character_images[main_char["id"]]}
-        ],
-        "dialogue": [
-            {
-                "speaker": character_names.get(main_char["id"], "Protagonist"),
-                "text": "I need to plan carefully before proceeding.",
-                "character": main_char["id"]
-            },
-            {
-                "speaker": "Narrator",
-                "text": "Taking your time to consider options might reveal hidden paths."
-            },
-            {
-                "speaker": character_names.get(main_char["id"], "Protagonist"),
-                "text": "What should I focus on first?",
-                "character": main_char["id"],
-                "choices": [
-                    {"text": "Study the situation", "nextScene": "scene_8"},
-                    {"text": "Prepare equipment", "nextScene": "scene_9"},
-                    {"text": "Consult with others", "nextScene": "scene_10"}
-                ]
-            }
-        ]
-    }
-    
-    vn_script["scenes"].append(planning_scene)
+    # Create main character path; characters is never empty here
+    mc_id = characters[0]["id"]
+    mc_name = character_names[mc_id]
+    mc_img = character_images[mc_id]
+    
+    # Protagonist scenes differ only in their lines and choices
+    for scene_id, background, opening, narration, question, choices in _PLACEHOLDER_PATH_SCENES:
+        vn_script["scenes"].append({
+            "id": scene_id,
+            "background": background,
+            "characters": [
+                {"id": mc_id, "image": mc_img}
+            ],
+            "dialogue": [
+                _char_line(mc_name, opening, mc_id),
+                _narrate(narration),
+                _char_line(mc_name, question, mc_id, [{"text": text, "nextScene": next_scene} for text, next_scene in choices])
+            ]
+        })
     
-    # Add fate scene
-    fate_scene = {
-        "id": "scene_4",
-        "background": backgrounds["dark"],
+    # Add fate scene, which is entirely static
+    scene_id, background, dialogue = _FATE_SCENE
+    vn_script["scenes"].append({
+        "id": scene_id,
+        "background": background,
         "characters": [],
-        "dialogue": [
-            {
-                "speaker": "Narrator",
-                "text": "You surrender to the flow of the story, letting fate guide your journey."
-            },
-            {
-                "speaker": "Narrator",
-                "text": "Sometimes the most interesting paths are those we don't choose ourselves."
-            },
-            {
-                "speaker": "Narrator",
-                "text": "As you drift with the current of the narrative, you find yourself drawn to...",
-                "choices": [
-                    {"text": "A mysterious encounter", "nextScene": "scene_7"},
-                    {"text": "An unexpected opportunity", "nextScene": "scene_8"},
-                    {"text": "A moment of revelation", "nextScene": "scene_9"}
-                ]
-            }
-        ]
-    }
-    
-    vn_script["scenes"].append(fate_scene)
-    
-    # Add several more placeholder scenes for other paths
-    basic_scenes = [
-        {"id": "scene_5", "background": backgrounds["main"]},
-        {"id": "scene_6", "background": backgrounds["secondary"]},
-        {"id": "scene_7", "background": backgrounds["dark"]},
-        {"id": "scene_8", "background": backgrounds["secondary"]},
-        {"id": "scene_9", "background": backgrounds["main"]},
-        {"id": "scene_10", "background": backgrounds["dark"]}
-    ]
+        "dialogue": _copy_dialogue(dialogue)
+    })
     
     # Populate basic scenes with simple content
-    for i, scene_info in enumerate(basic_scenes):
-        scene = {
-            "id": scene_info["id"],
-            "background": scene_info["background"],
-            "characters": [],
-            "dialogue": [
-                {
-                    "speaker": "Narrator",
-                    "text": f"Your journey continues along this path..."
-                },
-                {
-                    "speaker": "Narrator",
-                    "text": "What would you like to do next?",
-                    "choices": [
-                        {"text": "Return to the beginning", "nextScene": "scene_1"},
-                        {"text": "Continue on this path", "nextScene": "scene_1"}
-                    ]
-                }
-            ]
-        }
+    for i, (scene_id, background) in enumerate(_BASIC_SCENES):
+        opening, closing = _copy_dialogue(_BASIC_SCENE_DIALOGUE)
         
-        # Add a character to some scenes
+        # Add a character, and a line for them between the narration, to some scenes
         if i % 2 == 0 and characters:
-            char = characters[i % len(characters)]
-            scene["characters"].append({
-                "id": char["id"],
-                "image": character_images[char["id"]]
-            })
-            
-            # Add character dialogue
-            scene["dialogue"].insert(1, {
-                "speaker": character_names.get(char["id"], "Character"),
-                "text": "This path has its own challenges and rewards.",
-                "character": char["id"]
-            })
+            char_id = characters[i % len(characters)]["id"]
+            scene_characters = [{"id": char_id, "image": character_images[char_id]}]
+            dialogue = [
+                opening,
+                _char_line(character_names[char_id], "This path has its own challenges and rewards.", char_id),
+                closing
+            ]
+        else:
+            scene_characters = []
+            dialogue = [opening, closing]
         
-        vn_script["scenes"].append(scene)
+        vn_script["scenes"].append({
+            "id": scene_id,
+            "background": background,
+            "characters": scene_characters,
+            "dialogue": dialogue
+        })
     
     return vn_script
 
@@ -1100,57 +1759,58 @@ async def generate_next_scene(next_scene_id, client):
     Generate a new scene at runtime if it doesn't exist yet
     This is called by the frontend when a scene is needed but not yet generated
     """
+    generated_scenes = STORY_CACHE["generated_scenes"]
+    
     # Check if we already have this scene in cache
-    if next_scene_id in STORY_CACHE["generated_scenes"]:
-        return STORY_CACHE["generated_scenes"][next_scene_id]
+    cached = generated_scenes.get(next_scene_id)
+    if cached is not None:
+        return cached
+    
+    book_analysis = STORY_CACHE["book_analysis"]
     
     # Check if this scene is referenced in the scene graph
-    scene_graph = STORY_CACHE["scene_graph"]
-    if next_scene_id in scene_graph:
+    node = STORY_CACHE["scene_graph"].get(next_scene_id)
+    if node is not None:
         # Get info about incoming connections to help generate context
-        incoming = scene_graph[next_scene_id]["incoming"]
+        incoming = node["incoming"]
         
         # Create a simple outline for this scene
         scene_outline = {
             "id": next_scene_id,
-            "description": f"Continuation of the story from {', '.join([conn['source'] for conn in incoming])}",
+            "description": f"Continuation of the story from {', '.join(incoming)}",
             "characters": [],  # Will be populated based on context
             "setting": "A location appropriate to the story progression",
             "atmosphere": "Consistent with the narrative tone",
-            "dialogue_count": random.randint(7, 10),
+            "dialogue_count": _stable_dialogue_count(next_scene_id, 7, 10),
             "connects_to": []  # Will be filled dynamically
         }
         
-        # Get the book analysis from cache
-        book_analysis = STORY_CACHE["book_analysis"]
-        
-        # Try to determine characters based on incoming scenes
-        for conn in incoming:
-            source_id = conn["source"]
-            if source_id in STORY_CACHE["generated_scenes"]:
-                source_scene = STORY_CACHE["generated_scenes"][source_id]
+        # Try to determine characters based on incoming scenes, keeping
+        # first-seen order
+        seen = set()
+        for source_id in incoming:
+            source_scene = generated_scenes.get(source_id)
+            if source_scene is not None:
                 for char in source_scene.get("characters", []):
                     char_id = char.get("id")
-                    if char_id and char_id not in scene_outline["characters"]:
+                    if char_id and char_id not in seen:
+                        seen.add(char_id)
                         scene_outline["characters"].append(char_id)
+    else:
+        # If we don't have any info about this scene, create a generic one
+        logger.info("No context available for scene %s, creating generic scene", next_scene_id)
         
-        # Generate the scene
-        return await generate_scene_from_outline(scene_outline, book_analysis, client)
-    
-    # If we don't have any info about this scene, create a generic one
-    print(f"No context available for scene {next_scene_id}, creating generic scene")
-    
-    # Create a simple outline
-    scene_outline = {
-        "id": next_scene_id,
-        "description": "Continuation of the adventure",
-        "characters": [],
-        "setting": "A location within the story world",
-        "atmosphere": "Consistent with the narrative",
-        "dialogue_count": 8,
-        "connects_to": ["scene_next", "scene_alt"]
-    }
+        # Create a simple outline
+        scene_outline = {
+            "id": next_scene_id,
+            "description": "Continuation of the adventure",
+            "characters": [],
+            "setting": "A location within the story world",
+            "atmosphere": "Consistent with the narrative",
+            "dialogue_count": 8,
+            "connects_to": ["scene_next", "scene_alt"]
+        }
     
-    # Generate the scene using available book analysis
-    book_analysis = STORY_CACHE["book_analysis"]
-    return await generate_scene_from_outline(scene_outline, book_analysis, client)
\ No newline at end of file
+    # Generate the scene using available book analysis; these outlines are
+    # templates, so never reuse another scene built from the same one
+    return await generate_scene_from_outline(scene_outline, book_analysis, client, reuse_identical=False)
\ No newline at end of file